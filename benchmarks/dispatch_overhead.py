@@ -0,0 +1,75 @@
+"""
+Measures the time petal's dispatcher adds to every unary call, on top of calling the method directly,
+and the time recording metrics adds on top of that.
+
+Run with `python benchmarks/dispatch_overhead.py`. It exits with a non-zero status if either overhead is
+above the budget documented in the README.
+"""
+import sys
+import time
+import timeit
+from pathlib import Path
+
+# Run as a script, only this directory would be on the path rather than the checkout petal and the example are in.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from petal import Service  # noqa: E402
+from example.protobuf.greeter_pb2 import HelloReply, HelloRequest  # noqa: E402
+
+OVERHEAD_BUDGET_NS = 500
+METRICS_BUDGET_NS = 1000
+CALLS = 200_000
+
+service = Service('example')
+metrics_service = Service('example')
+metrics_service.enable_metrics()
+reply = HelloReply()
+
+
+class Context:
+    # Like grpc's own context, which works the time remaining out from the deadline on every call.
+    deadline = float('inf')
+
+    def time_remaining(self):
+        return max(self.deadline - time.time(), 0)
+
+    def peer(self):
+        return 'ipv4:127.0.0.1:1234'
+
+    def set_code(self, code):
+        pass
+
+    def set_details(self, details):
+        pass
+
+    def code(self):
+        return None
+
+
+def say_hello(request: HelloRequest) -> HelloReply:
+    return reply
+
+
+def main():
+    request, context_object = HelloRequest(), Context()
+    dispatcher = service.grpc()(say_hello)
+    metrics_service.grpc()(say_hello)
+    measured = metrics_service.rpc_methods[0].function
+
+    direct = min(timeit.repeat(lambda: say_hello(request), number=CALLS, repeat=5))
+    dispatched = min(timeit.repeat(lambda: dispatcher(request, context_object), number=CALLS, repeat=5))
+    with_metrics = min(timeit.repeat(lambda: measured(request, context_object), number=CALLS, repeat=5))
+    overhead_ns = (dispatched - direct) / CALLS * 1e9
+    metrics_ns = (with_metrics - dispatched) / CALLS * 1e9
+
+    print(f'Direct call:      {direct / CALLS * 1e9:8.1f} ns')
+    print(f'Dispatched call:  {dispatched / CALLS * 1e9:8.1f} ns')
+    print(f'With metrics:     {with_metrics / CALLS * 1e9:8.1f} ns')
+    print(f'Overhead:         {overhead_ns:8.1f} ns (budget {OVERHEAD_BUDGET_NS} ns)')
+    print(f'Metrics overhead: {metrics_ns:8.1f} ns (budget {METRICS_BUDGET_NS} ns)')
+    if overhead_ns > OVERHEAD_BUDGET_NS or metrics_ns > METRICS_BUDGET_NS:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
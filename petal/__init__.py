@@ -1,18 +1,51 @@
 import functools
-import contextvars
+import inspect
 import grpc
-from typing import Callable, List, get_type_hints, Type, NamedTuple, Dict, Iterable
+from pathlib import Path
+from types import CodeType
+from typing import Callable, List, get_type_hints, Type, NamedTuple, Dict, Iterable, AsyncIterable, Union, Optional, \
+    Tuple, Any
 
 from google.protobuf.message import Message
 
-from .grpc_services import load_all_grpc_services, GRPCMethod, GRPCService
+from .grpc_services import load_all_grpc_services, read_manifest, load_manifest_service, GRPCMethod, \
+    GRPCService
 from .exceptions import MultipleServicesDefined, NoServicesDefined, AmbiguousMethod, IncorrectMethodArguments, \
-    AmbiguousGRPCMethod
+    AmbiguousGRPCMethod, UnsupportedMethodOption
+from .access_log import AccessLog
+from .admission import AdmissionController
+from .batch import batch_dispatcher
+from .bulkhead import Bulkhead, BulkheadStats, ServerThreads, load_bulkhead_config
+from .cache import ResponseCache, CacheStats
+from .capture import Capture
+from .chunking import DEFAULT_CHUNK_BYTES, chunk_responses, find_chunk_field
+from .client import Client, RetryBudget
+from .coalesce import coalesce_dispatcher, async_coalesce_dispatcher
+from .dispatch import context, time_remaining, cancelled, create_dispatcher, serialized_dispatcher
+from .messages import Raw, Lazy, unwrap_encoding
+from .metrics import Metrics, MethodMetrics
+from .process import ProcessPool
+from .profiler import Profiler
+from .read_ahead import batches, read_ahead
+from .testing import TestClient
+from .tracing import Tracer, current_span
 from . import log
 
-context = contextvars.ContextVar('petal.context')
+__all__ = ['Service', 'ResponseCache', 'Raw', 'Lazy', 'Bulkhead', 'ServerThreads', 'AdmissionController', 'AccessLog',
+           'Tracer', 'Capture', 'Client', 'RetryBudget', 'time_remaining', 'cancelled', 'current_span', 'batches']
 
-__all__ = ['Service']
+
+def is_stream(annotation) -> bool:
+    origin = getattr(annotation, '__origin__', None)
+    return origin is not None and issubclass(origin, (Iterable, AsyncIterable))
+
+
+def message_type(annotation) -> Type:
+    return unwrap_encoding(annotation.__args__[0] if is_stream(annotation) else annotation)[0]
+
+
+def message_encoding(annotation) -> Optional[type]:
+    return unwrap_encoding(annotation.__args__[0] if is_stream(annotation) else annotation)[1]
 
 
 class Handler(NamedTuple):
@@ -20,17 +53,80 @@ class Handler(NamedTuple):
     function: Callable
     input: Type
     output: Type
+    is_async: bool = False
+    python_function: Optional[Callable] = None
+    cache: Optional[ResponseCache] = None
+    coalesce: bool = False
+    batch_size: Optional[int] = None
+    max_wait_ms: float = 10
+    process_pool: Optional[ProcessPool] = None
+    bulkhead: Optional[Bulkhead] = None
+    priority: float = 1.0
+    chunk_type: Optional[Type] = None
+    chunk_field: Optional[str] = None
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES
+    read_ahead: Optional[int] = None
+    read_ahead_bytes: Optional[int] = None
 
     @property
     def python_name(self):
         return self.function.__name__
 
-    def create_method_handler(self) -> grpc.RpcMethodHandler:
-        stream_input = hasattr(self.input, '__origin__') and issubclass(self.input.__origin__, Iterable)
-        stream_output = hasattr(self.output, '__origin__') and issubclass(self.output.__origin__, Iterable)
-        input_type = self.input if not stream_input else self.input.__args__[0]
-        output_type = self.output if not stream_output else self.output.__args__[0]
+    @property
+    def batched(self) -> bool:
+        # Batched handlers take a list of requests and return a list of responses, but serve a unary method.
+        return self.batch_size is not None
+
+    @property
+    def chunked(self) -> bool:
+        # Chunked handlers return an iterator of items, streamed packed into chunk_type messages.
+        return self.chunk_type is not None
+
+    @property
+    def reads_ahead(self) -> bool:
+        # Handlers reading ahead are given serialized requests by gRPC, and parse them on their own thread.
+        return self.read_ahead is not None or self.read_ahead_bytes is not None
+
+    @property
+    def stream_input(self) -> bool:
+        return is_stream(self.input) and not self.batched
+
+    @property
+    def stream_output(self) -> bool:
+        return is_stream(self.output) and not self.batched
+
+    @property
+    def serialized(self) -> bool:
+        # Serialized handlers are given the raw request bytes and return raw response bytes.
+        return self.cache is not None or self.coalesce or self.process_pool is not None
+
+    @property
+    def input_type(self) -> Type:
+        return message_type(self.input)
+
+    @property
+    def output_type(self) -> Type:
+        return self.chunk_type if self.chunked else message_type(self.output)
+
+    @property
+    def request_deserializer(self) -> Optional[Callable]:
+        encoding = message_encoding(self.input)
+        if encoding is Raw:
+            return None
+        if encoding is Lazy:
+            return functools.partial(Lazy, self.input_type)
+        return self.input_type.FromString
 
+    @property
+    def response_serializer(self) -> Optional[Callable]:
+        encoding = message_encoding(self.output)
+        if encoding is Raw:
+            return None
+        if encoding is Lazy:
+            return Lazy.SerializeToString
+        return self.output_type.SerializeToString
+
+    def create_method_handler(self, metrics: MethodMetrics = None) -> grpc.RpcMethodHandler:
         handlers = {
             (False, False): grpc.unary_unary_rpc_method_handler,
             (True, False): grpc.stream_unary_rpc_method_handler,
@@ -38,11 +134,18 @@ class Handler(NamedTuple):
             (True, True): grpc.stream_stream_rpc_method_handler,
         }
 
-        constructor = handlers[(stream_input, stream_output)]
+        # grpc.aio inspects the behaviour itself to decide whether to await it, iterate it
+        # asynchronously or run it in the migration thread pool, so the constructors are shared.
+        constructor = handlers[(self.stream_input, self.stream_output)]
+        request_deserializer = None if self.serialized or self.reads_ahead else self.request_deserializer
+        response_serializer = None if self.serialized else self.response_serializer
+        if metrics is not None:
+            request_deserializer = metrics.wrap_deserializer(request_deserializer)
+            response_serializer = metrics.wrap_serializer(response_serializer)
         return constructor(
             self.function,
-            request_deserializer=input_type.FromString,
-            response_serializer=output_type.SerializeToString
+            request_deserializer=request_deserializer,
+            response_serializer=response_serializer
         )
 
 
@@ -52,7 +155,8 @@ def camel_case_name(name):
 
 @functools.lru_cache()
 def load_grpc_service(package, service_name=None) -> GRPCService:
-    all_services = load_all_grpc_services(package)
+    manifest = read_manifest(package)
+    all_services = load_all_grpc_services(package) if manifest is None else manifest
 
     if not all_services:
         raise NoServicesDefined()
@@ -60,11 +164,12 @@ def load_grpc_service(package, service_name=None) -> GRPCService:
     if len(all_services) > 1:
         if not service_name:
             raise MultipleServicesDefined(all_services.keys())
-        service = all_services[service_name]
     else:
-        service = all_services[list(all_services.keys())[0]]
+        service_name = list(all_services.keys())[0]
 
-    return service
+    if manifest is not None:
+        return load_manifest_service(service_name, manifest[service_name])
+    return all_services[service_name]
 
 
 class Service:
@@ -72,50 +177,306 @@ class Service:
         self.package = package
         self.service_name = service_name
         self.rpc_methods: List[Handler] = []
+        self.bulkheads: Dict[str, Bulkhead] = {}
+        self.metrics: Optional[Metrics] = None
+        self.admission: Optional[AdmissionController] = None
+        self.access_log: Optional[AccessLog] = None
+        self.tracer: Optional[Tracer] = None
+        self.capture: Optional[Capture] = None
+        # Limits the calls to the whole service, when it shares a server with others.
+        self.concurrency: Optional[Bulkhead] = None
+        # Built by `dispatch`, for functions that aren't registered with `grpc`.
+        self.direct_dispatchers: Dict[Callable, Callable] = {}
+        # Put in front of method and bulkhead names in metrics and profiles, to tell apart services sharing a process.
+        self.name_prefix = ''
         self.logger = log.logger
 
+    def create_dispatcher(self, handler: 'Handler') -> Callable:
+        function = handler.python_function
+        if handler.chunked:
+            field = handler.chunk_type.DESCRIPTOR.fields_by_name[handler.chunk_field]
+            function = chunk_responses(function, handler.chunk_type, field, handler.chunk_bytes)
+        if handler.reads_ahead:
+            function = read_ahead(function, handler.request_deserializer, handler.stream_output, handler.read_ahead,
+                                  handler.read_ahead_bytes)
+        if handler.process_pool is not None:
+            # Already takes and returns serialized messages.
+            function = handler.process_pool.wrap(function)
+        if handler.bulkhead is not None:
+            function = handler.bulkhead.wrap(function, handler.stream_output)
+        if self.concurrency is not None:
+            function = self.concurrency.wrap(function, handler.stream_output)
+        if self.admission is not None:
+            function = self.admission.wrap(function, handler.stream_output, handler.priority,
+                                           measure=not (handler.stream_input or handler.stream_output))
+        # A batch or coalesced call runs on behalf of several callers, which are checked for their own deadlines.
+        dispatcher = create_dispatcher(function, handler.stream_output, self.logger,
+                                       deadline=not (handler.batched or handler.coalesce))
+        if handler.batched:
+            dispatcher = batch_dispatcher(dispatcher, handler.batch_size, handler.max_wait_ms, handler.is_async)
+        if handler.serialized and handler.process_pool is None:
+            dispatcher = serialized_dispatcher(dispatcher, handler.request_deserializer, handler.response_serializer,
+                                               handler.is_async)
+        if handler.coalesce:
+            dispatcher = (async_coalesce_dispatcher if handler.is_async else coalesce_dispatcher)(dispatcher)
+        if handler.cache is not None:
+            dispatcher = handler.cache.wrap(dispatcher, handler.is_async)
+        if self.metrics is not None:
+            dispatcher = self.metrics.method(self.qualified_name(handler.name)).wrap(dispatcher, handler.stream_output)
+        if self.access_log is not None:
+            dispatcher = self.access_log.wrap(dispatcher, self.qualified_name(handler.name), handler.stream_input,
+                                              handler.stream_output)
+        if self.capture is not None or self.tracer is not None:
+            full_name = load_grpc_service(self.package, self.service_name).full_name
+        if self.capture is not None:
+            dispatcher = self.capture.wrap(dispatcher, f'/{full_name}/{handler.name}', handler.stream_input,
+                                           handler.stream_output)
+        if self.tracer is not None:
+            dispatcher = self.tracer.wrap(dispatcher, f'{full_name}/{handler.name}', handler.stream_input,
+                                          handler.stream_output)
+        return dispatcher
+
+    def rebuild_dispatchers(self):
+        # Dispatchers only include the features enabled when they were built.
+        self.rpc_methods = [method._replace(function=self.create_dispatcher(method)) for method in self.rpc_methods]
+
+    def qualified_name(self, name: str) -> str:
+        return f'{self.name_prefix}{name}'
+
+    def enable_metrics(self, metrics: Metrics = None) -> Metrics:
+        """
+        Record metrics for every method, into `metrics` if several services should be exported together.
+        """
+        if self.metrics is None:
+            self.metrics = metrics or Metrics()
+            self.metrics.add_collector(self.collect_metrics)
+            self.rebuild_dispatchers()
+        return self.metrics
+
+    def enable_admission_control(self, controller: AdmissionController = None) -> AdmissionController:
+        if self.admission is None:
+            self.admission = controller or AdmissionController()
+            self.rebuild_dispatchers()
+        return self.admission
+
+    def enable_access_log(self, access_log: AccessLog = None) -> AccessLog:
+        """
+        Record every call to `access_log`, which writes nothing until its `start()` method is called.
+        """
+        if self.access_log is None:
+            self.access_log = access_log or AccessLog()
+            self.rebuild_dispatchers()
+        return self.access_log
+
+    def enable_tracing(self, tracer: Tracer) -> Tracer:
+        """
+        Trace calls with `tracer`, which exports nothing until its `start()` method is called. Methods can find the
+        span of their call with `petal.current_span()`.
+        """
+        if self.tracer is None:
+            self.tracer = tracer
+            self.rebuild_dispatchers()
+        return self.tracer
+
+    def enable_capture(self, capture: Capture) -> Capture:
+        """
+        Record a sample of calls with `capture`, which writes nothing until its `start()` method is called.
+        """
+        if self.capture is None:
+            self.capture = capture
+            self.rebuild_dispatchers()
+        return self.capture
+
+    def limit_concurrency(self, max_concurrent: int, max_queue: int = 0) -> Bulkhead:
+        """
+        Limit how many calls to any of the service's methods run at once, like a bulkhead around the whole service,
+        so it cannot take every thread from other services hosted on the same server.
+        """
+        if self.concurrency is None:
+            self.concurrency = Bulkhead(name='service')
+            self.rebuild_dispatchers()
+        self.concurrency.configure(max_concurrent, max_queue)
+        return self.concurrency
+
+    def profiled_methods(self) -> Dict[CodeType, str]:
+        return {inspect.unwrap(method.python_function).__code__: self.qualified_name(method.name)
+                for method in self.rpc_methods}
+
+    def create_profiler(self, output_directory: Path, rate: float = 100) -> Profiler:
+        return Profiler(self.profiled_methods(), output_directory, rate)
+
+    def collect_metrics(self):
+        for name, stats in self.cache_stats().items():
+            for field in ('hits', 'misses', 'evictions', 'expirations'):
+                yield f'petal_cache_{field}_total', 'counter', {'method': name}, getattr(stats, field)
+            yield 'petal_cache_entries', 'gauge', {'method': name}, stats.entries
+            yield 'petal_cache_bytes', 'gauge', {'method': name}, stats.bytes
+        for name, stats in self.bulkhead_stats().items():
+            yield 'petal_bulkhead_active', 'gauge', {'bulkhead': name}, stats.active
+            yield 'petal_bulkhead_queued', 'gauge', {'bulkhead': name}, stats.queued
+            yield 'petal_bulkhead_rejected_total', 'counter', {'bulkhead': name}, stats.rejected
+            yield 'petal_bulkhead_completed_total', 'counter', {'bulkhead': name}, stats.completed
+        if self.admission is not None:
+            stats = self.admission.stats()
+            yield 'petal_admission_limit', 'gauge', {}, stats.limit
+            yield 'petal_admission_in_flight', 'gauge', {}, stats.in_flight
+            yield 'petal_admission_admitted_total', 'counter', {}, stats.admitted
+            yield 'petal_admission_rejected_total', 'counter', {}, stats.rejected
+        if self.access_log is not None:
+            stats = self.access_log.stats()
+            yield 'petal_access_log_written_total', 'counter', {}, stats.written
+            yield 'petal_access_log_dropped_total', 'counter', {}, stats.dropped
+            yield 'petal_access_log_buffered', 'gauge', {}, stats.buffered
+        if self.tracer is not None:
+            stats = self.tracer.stats()
+            yield 'petal_tracing_spans_exported_total', 'counter', {}, stats.exported
+            yield 'petal_tracing_spans_dropped_total', 'counter', {}, stats.dropped
+            yield 'petal_tracing_spans_buffered', 'gauge', {}, stats.buffered
+        if self.capture is not None:
+            stats = self.capture.stats()
+            yield 'petal_capture_written_total', 'counter', {}, stats.written
+            yield 'petal_capture_dropped_total', 'counter', {}, stats.dropped
+            yield 'petal_capture_buffered', 'gauge', {}, stats.buffered
+
     def dispatch(self, request_object: Message, context_object: grpc.ServicerContext, func: Callable):
-        ctx = contextvars.copy_context()
-        context.set(context_object)
-
-        bound_logger = self.logger.bind(peer=context_object.peer())
-
-        with bound_logger.catch():
-            try:
-                return ctx.run(func, request_object)
-            except exceptions.GRPCError as e:
-                context_object.set_code(e.code)
-                if e.details:
-                    context_object.set_details(e.details)
-            except NotImplementedError:
-                context_object.set_code(grpc.StatusCode.UNIMPLEMENTED)
-
-    def grpc(self, name: str = None):
-        def inner(func):
-            @functools.wraps(func)
-            def wrapper(request_object, context_object):
-                return self.dispatch(request_object, context_object, func)
+        # Kept for code that dispatches calls itself. The dispatcher is built once for each function, not each call.
+        dispatcher = self.direct_dispatchers.get(func)
+        if dispatcher is None:
+            stream_output = is_stream(get_type_hints(func).get('return'))
+            dispatcher = self.direct_dispatchers[func] = create_dispatcher(func, stream_output, self.logger)
+        return dispatcher(request_object, context_object)
 
+    @property
+    def is_async(self) -> bool:
+        return any(method.is_async for method in self.rpc_methods)
+
+    def cache_stats(self) -> Dict[str, CacheStats]:
+        return {self.qualified_name(method.name): method.cache.stats()
+                for method in self.rpc_methods if method.cache is not None}
+
+    def bulkhead(self, name: str, max_concurrent: int = None, max_queue: int = None) -> Bulkhead:
+        """
+        Get or create the bulkhead shared by every method registered with `service.grpc(bulkhead=name)`,
+        updating its limits if they are given.
+        """
+        if name not in self.bulkheads:
+            self.bulkheads[name] = Bulkhead(name=name)
+        bulkhead = self.bulkheads[name]
+        if max_concurrent is not None or max_queue is not None:
+            bulkhead.configure(max_concurrent, max_queue or 0)
+        return bulkhead
+
+    def load_bulkheads(self, path: Path):
+        for name, settings in load_bulkhead_config(path).items():
+            self.bulkhead(name, settings.get('max_concurrent'), settings.get('max_queue', 0))
+
+    def fit_bulkheads(self, threads: ServerThreads):
+        """
+        Tell the service's bulkheads about the threads of the server, shared with the bulkheads of any other service
+        it serves, so synchronous calls waiting for a slot never hold all of them.
+        """
+        for bulkhead in self.bulkheads.values():
+            bulkhead.threads = threads
+        if self.concurrency is not None:
+            self.concurrency.threads = threads
+
+    def bulkhead_stats(self) -> Dict[str, BulkheadStats]:
+        bulkheads = list(self.bulkheads.values())
+        if self.concurrency is not None:
+            bulkheads.append(self.concurrency)
+        return {self.qualified_name(bulkhead.name): bulkhead.stats() for bulkhead in bulkheads}
+
+    def grpc(self, name: str = None, cache: Union[bool, ResponseCache] = None, coalesce: bool = False,
+             batch_size: int = None, max_wait_ms: float = 10, executor: str = None, workers: int = None,
+             bulkhead: Union[str, Bulkhead] = None, priority: float = 1.0, chunk_type: Type = None,
+             chunk_field: str = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES, read_ahead: int = None,
+             read_ahead_bytes: int = None):
+        def inner(func):
             hints = get_type_hints(func)
             request_type = hints['request']
             return_type = hints['return']
 
-            self.rpc_methods.append(
-                Handler(
-                    name=name or camel_case_name(func.__name__),
-                    function=wrapper,
-                    input=request_type,
-                    output=return_type,
-                )
+            handler = Handler(
+                name=name or camel_case_name(func.__name__),
+                function=func,
+                python_function=func,
+                input=request_type,
+                output=return_type,
+                is_async=inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func),
+                cache=ResponseCache() if cache is True else cache or None,
+                coalesce=coalesce,
+                batch_size=batch_size,
+                max_wait_ms=max_wait_ms,
+                priority=priority,
+                chunk_type=chunk_type,
+                chunk_field=chunk_field,
+                chunk_bytes=chunk_bytes,
+                read_ahead=read_ahead,
+                read_ahead_bytes=read_ahead_bytes,
             )
+            if executor == 'process':
+                if handler.is_async or handler.stream_input or handler.stream_output or handler.batched:
+                    raise UnsupportedMethodOption(handler.python_name, 'executor',
+                                                  'only synchronous unary methods can run in a process pool')
+                handler = handler._replace(process_pool=ProcessPool(func.__module__, handler.name, workers))
+            elif executor is not None:
+                raise UnsupportedMethodOption(handler.python_name, 'executor', f'unknown executor {executor}')
+
+            if isinstance(bulkhead, str):
+                handler = handler._replace(bulkhead=self.bulkhead(bulkhead))
+            elif bulkhead is not None:
+                bulkhead.name = bulkhead.name or handler.name
+                self.bulkheads[bulkhead.name] = bulkhead
+                handler = handler._replace(bulkhead=bulkhead)
+            if not 0 < priority <= 1:
+                raise UnsupportedMethodOption(handler.python_name, 'priority', 'priority must be above 0 and at most 1')
+            if handler.batched and not (getattr(request_type, '__origin__', None) is list and
+                                        getattr(return_type, '__origin__', None) is list):
+                raise UnsupportedMethodOption(handler.python_name, 'batch_size',
+                                              'batched methods must take and return a List of messages')
+            if handler.cache is not None and (handler.stream_input or handler.stream_output):
+                raise UnsupportedMethodOption(handler.python_name, 'cache', 'only unary methods can be cached')
+            if handler.coalesce and (handler.stream_input or handler.stream_output):
+                raise UnsupportedMethodOption(handler.python_name, 'coalesce', 'only unary methods can be coalesced')
+            if chunk_field is not None and chunk_type is None:
+                raise UnsupportedMethodOption(handler.python_name, 'chunk_field', 'chunk_field needs a chunk_type')
+            if handler.chunked:
+                if not handler.stream_output:
+                    raise UnsupportedMethodOption(handler.python_name, 'chunk_type',
+                                                  'chunked methods must return an Iterable of the items to send')
+                try:
+                    field = find_chunk_field(chunk_type, message_type(return_type), chunk_field)
+                except ValueError as e:
+                    raise UnsupportedMethodOption(handler.python_name, 'chunk_field', str(e))
+                handler = handler._replace(chunk_field=field.name)
+            if handler.reads_ahead:
+                if handler.is_async or not handler.stream_input:
+                    raise UnsupportedMethodOption(handler.python_name, 'read_ahead',
+                                                  'only synchronous client streaming methods can read ahead')
+                if (read_ahead or 1) < 1 or (read_ahead_bytes or 1) < 1:
+                    raise UnsupportedMethodOption(handler.python_name, 'read_ahead', 'limits must be at least 1')
+            wrapper = self.create_dispatcher(handler)
+            self.rpc_methods.append(handler._replace(function=wrapper))
 
             return wrapper
 
         return inner
 
+    def start_process_pools(self):
+        for method in self.rpc_methods:
+            if method.process_pool is not None:
+                method.process_pool.start()
+
+    def stop_process_pools(self):
+        for method in self.rpc_methods:
+            if method.process_pool is not None:
+                method.process_pool.stop()
+
     def create_service_handler(self) -> 'grpc.ServiceRpcHandler':
+        self.start_process_pools()
         handlers = {
-            method.name: method.create_method_handler()
+            method.name: method.create_method_handler(
+                self.metrics and self.metrics.method(self.qualified_name(method.name)))
             for method in self.rpc_methods
         }
         service = load_grpc_service(self.package, self.service_name)
@@ -124,6 +485,14 @@ class Service:
             handlers
         )
 
+    def test_client(self, mode: str = 'direct', metadata: Iterable[Tuple[str, Any]] = (),
+                    timeout: float = None) -> TestClient:
+        """
+        A client calling this service's methods in-process. "direct" mode passes messages straight to the methods,
+        "wire" mode serializes and parses every message like a real call would.
+        """
+        return TestClient(self, mode, metadata, timeout)
+
     def validate_service(self):
         service = load_grpc_service(self.package, self.service_name)
         method_name_mapping: Dict[str, GRPCMethod] = {method.name: method for method in service.methods}
@@ -136,16 +505,18 @@ class Service:
             # Check the types are correct
             input_type = grpc_method.input_type
             output_type = grpc_method.output_type
-
-            if grpc_method.input_stream:
-                input_type = Iterable[input_type]
-            if grpc_method.output_stream:
-                output_type = Iterable[output_type]
-
-            if method.input != input_type:
-                raise IncorrectMethodArguments(method.python_name, 'input', method.input, input_type)
-            if method.output != output_type:
-                raise IncorrectMethodArguments(method.python_name, 'output', method.output, output_type)
+            stream_type = AsyncIterable if method.is_async else Iterable
+
+            if method.batched and (grpc_method.input_stream or grpc_method.output_stream):
+                raise UnsupportedMethodOption(method.python_name, 'batch_size', 'only unary methods can be batched')
+            if (method.stream_input, method.input_type) != (grpc_method.input_stream, input_type):
+                expected = stream_type[input_type] if grpc_method.input_stream else input_type
+                raise IncorrectMethodArguments(method.python_name, 'input', method.input,
+                                               List[expected] if method.batched else expected)
+            if (method.stream_output, method.output_type) != (grpc_method.output_stream, output_type):
+                expected = stream_type[output_type] if grpc_method.output_stream else output_type
+                raise IncorrectMethodArguments(method.python_name, 'output', method.output,
+                                               List[expected] if method.batched else expected)
             found_methods.add(grpc_method)
 
         missing_methods = set(service.methods) - found_methods
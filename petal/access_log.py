@@ -0,0 +1,142 @@
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, Optional, Callable, Any, NamedTuple, List
+
+from .background import BackgroundBuffer, wall_clock_offset
+from .dispatch import wrap_calls
+from .log import logger
+from .metrics import status_code
+
+# A field is computed from the request and response of a call, on the writer thread.
+Field = Callable[[Any, Any], Any]
+
+
+class AccessLogStats(NamedTuple):
+    written: int
+    dropped: int
+    buffered: int
+
+
+class AccessLog:
+    """
+    Records one JSON line per call. Calls only put a tuple in a bounded buffer, and a background thread formats and
+    writes the buffered records in batches, so a slow disk never slows a call down. When the buffer is full new
+    records are dropped and counted instead of waiting for space.
+
+    `sample_rates` maps method names to the fraction of their calls to record, for methods busy enough that
+    `default_rate` would be too many. `fields` adds computed fields to every record, as functions of the request and
+    response that only run on the writer thread. Streamed requests and responses are passed as None.
+    """
+
+    def __init__(self, path: str = '-', capacity: int = 65536, batch_size: int = 1024, flush_interval: float = 1.0,
+                 sample_rates: Dict[str, float] = None, default_rate: float = 1.0, fields: Dict[str, Field] = None):
+        self.path = path
+        self.sample_rates = sample_rates or {}
+        self.default_rate = default_rate
+        self.fields = fields or {}
+        # Lines are put together by hand, only values that could need escaping go through the encoder.
+        self.encoder = json.JSONEncoder(default=str, separators=(',', ':'))
+        self.quoted: Dict[str, str] = {}
+        self.quoted_fields = {field: json.dumps(field) for field in self.fields}
+        self.buffer = BackgroundBuffer(self.write_batch, capacity, batch_size, flush_interval, 'petal-access-log')
+        self.written = 0
+        self.failed = 0
+        self.fd: Optional[int] = None
+        self.failing = False
+
+    def rate(self, name: str) -> float:
+        return self.sample_rates.get(name, self.default_rate)
+
+    def wrap(self, dispatcher: Callable, name: str, stream_input: bool, stream_output: bool) -> Callable:
+        """
+        Wrap the outermost dispatcher of a method to record each call it handles.
+        """
+        rate = self.rate(name)
+        if rate <= 0:
+            return dispatcher
+        sampled = rate < 1
+        keep_messages = bool(self.fields)
+        add, perf_counter = self.buffer.add, time.perf_counter
+
+        def enter(request, context_object) -> Optional[tuple]:
+            if sampled and random.random() >= rate:
+                return None
+            return perf_counter(), request, context_object
+
+        def leave(state: Optional[tuple], result):
+            if state is None:
+                return
+            # Everything but the status is worked out later, on the writer thread.
+            start, request, context_object = state
+            end = perf_counter()
+            response = None if stream_output or not keep_messages else result
+            add((name, end, end - start, status_code(context_object, result),
+                 None if stream_input or not keep_messages else request, response))
+
+        return wrap_calls(dispatcher, stream_output, enter, leave)
+
+    def stats(self) -> AccessLogStats:
+        return AccessLogStats(written=self.written, dropped=self.buffer.dropped + self.failed,
+                              buffered=len(self.buffer))
+
+    def start(self):
+        """
+        Start the writer thread. Forked worker processes each start their own.
+        """
+        if self.buffer.running:
+            return
+        if self.path == '-':
+            self.fd = sys.stdout.fileno()
+        else:
+            # Workers append to the same file, each batch is written at once so their lines are not mixed up.
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.buffer.start()
+
+    def stop(self):
+        """
+        Write the remaining records and stop the writer thread.
+        """
+        if not self.buffer.running:
+            return
+        self.buffer.stop()
+        if self.path != '-':
+            os.close(self.fd)
+        self.fd = None
+
+    def write_batch(self, batch: List[tuple]):
+        self.write(self.format(batch))
+
+    def format(self, batch: List[tuple]) -> bytes:
+        offset = wall_clock_offset()
+        dumps = self.encoder.encode
+        lines = []
+        for name, end, duration, code, request, response in batch:
+            if name not in self.quoted:
+                self.quoted[name] = dumps(name)
+            line = (f'{{"time":{end + offset:.6f},"method":{self.quoted[name]},"code":"{code.name}",'
+                    f'"duration_ms":{duration * 1000:.3f}')
+            for field, compute in self.fields.items():
+                try:
+                    value = dumps(compute(request, response))
+                except Exception:
+                    value = 'null'
+                line += f',{self.quoted_fields[field]}:{value}'
+            lines.append(line + '}')
+        return ('\n'.join(lines) + '\n').encode()
+
+    def write(self, data: bytes):
+        count = data.count(b'\n')
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            self.failed += count
+            if not self.failing:
+                logger.warning(f'Could not write the access log to {self.path}, dropping records: {e}')
+            self.failing = True
+            return
+        self.failing = False
+        self.written += count
@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+from typing import NamedTuple, Callable, Type
+
+from . import exceptions
+from .dispatch import ServerExecutor, wrap_calls
+
+
+class AdmissionStats(NamedTuple):
+    limit: int
+    in_flight: int
+    admitted: int
+    rejected: int
+
+
+class GradientLimit:
+    """
+    Compares the average latency of the last window with the long term average. While they agree the limit grows by
+    sqrt(limit) each window, and as latency rises above the long term average the limit shrinks in proportion.
+    """
+
+    def __init__(self, initial_limit: int = 20, min_limit: int = 1, max_limit: int = 1000, tolerance: float = 1.5,
+                 smoothing: float = 0.2, long_window: int = 600):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.long_window = long_window
+        self.long_rtt = None
+
+    def update(self, rtt: float, in_flight: int) -> float:
+        if self.long_rtt is None:
+            self.long_rtt = rtt
+        else:
+            self.long_rtt += (rtt - self.long_rtt) / self.long_window
+            if self.long_rtt / rtt > 2:
+                # Latency has recovered from a period of overload, forget it faster.
+                self.long_rtt *= 0.95
+
+        # An idle service tells us nothing about how much more it could take.
+        if in_flight < self.limit / 2:
+            return self.limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / rtt))
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+        return self.limit
+
+
+class AIMDLimit:
+    """
+    Grows the limit by one each window while it is being used, and cuts it by `backoff` whenever the average latency
+    of a window goes over `timeout` seconds.
+    """
+
+    def __init__(self, initial_limit: int = 20, min_limit: int = 1, max_limit: int = 1000, backoff: float = 0.9,
+                 timeout: float = 0.5):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def update(self, rtt: float, in_flight: int) -> float:
+        if rtt > self.timeout:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif in_flight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1)
+        return self.limit
+
+
+class AdmissionController:
+    """
+    Limits how many calls the whole service runs at once, adjusting the limit from the latency of finished calls.
+    Calls over the limit are rejected straight away rather than queueing behind the ones already running.
+
+    A method with a `priority` below 1 is only admitted while fewer than `limit * priority` calls are running,
+    so less important methods are shed first.
+
+    On a server whose thread pool comes from `executor()`, calls take their place under the limit when they arrive
+    rather than when a thread picks them up, so calls waiting for a thread count towards it and their latency
+    includes the wait. Calls over the limit still wait for a thread to be turned away, but only hold it for a moment.
+    """
+
+    def __init__(self, limit=None, window: float = 1.0, min_samples: int = 10,
+                 rejection: Type[exceptions.GRPCError] = exceptions.ResourceExhausted):
+        self.algorithm = limit or GradientLimit()
+        self.limit = self.algorithm.limit
+        self.window = window
+        self.min_samples = min_samples
+        self.rejection = rejection
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.window_start = time.perf_counter()
+        self.rtt_sum = 0.0
+        self.samples = 0
+        self.max_in_flight = 0
+        # When the call running on each thread of the executor arrived, and the place it was given then.
+        self.arrival = threading.local()
+
+    def executor(self, max_workers: int) -> ServerExecutor:
+        """
+        A thread pool for the gRPC server that lets the controller see calls waiting for a thread.
+        """
+        return TrackingExecutor(self, max_workers)
+
+    def reserve(self, priority: float = 1.0) -> int:
+        """
+        Take a place under the limit if there is one, returning how many calls held one before, or -1 if there isn't.
+        """
+        with self.lock:
+            load = self.in_flight
+            if load >= self.limit * priority:
+                return -1
+            self.in_flight += 1
+            if self.in_flight > self.max_in_flight:
+                self.max_in_flight = self.in_flight
+            return load
+
+    def acquire(self, priority: float = 1.0) -> float:
+        arrival = self.arrival
+        start = getattr(arrival, 'time', None)
+        if start is None:
+            load = self.reserve(priority)
+        else:
+            # The place was taken against the whole limit when the call arrived, before its method was known.
+            arrival.claimed = True
+            load = arrival.load
+            if load >= self.limit * priority:
+                self.release()
+                load = -1
+        with self.lock:
+            if load < 0:
+                self.rejected += 1
+            else:
+                self.admitted += 1
+        if load < 0:
+            raise self.rejection('Server is overloaded')
+        return time.perf_counter() if start is None else start
+
+    def release(self, start: float = None):
+        now = time.perf_counter()
+        with self.lock:
+            self.in_flight -= 1
+            if start is None:
+                return
+            self.rtt_sum += now - start
+            self.samples += 1
+            if self.samples >= self.min_samples and now - self.window_start >= self.window:
+                self.limit = self.algorithm.update(self.rtt_sum / self.samples, self.max_in_flight)
+                self.window_start = now
+                self.rtt_sum = 0.0
+                self.samples = 0
+                self.max_in_flight = self.in_flight
+
+    def stats(self) -> AdmissionStats:
+        with self.lock:
+            return AdmissionStats(limit=int(self.limit), in_flight=self.in_flight, admitted=self.admitted,
+                                  rejected=self.rejected)
+
+    def wrap(self, func: Callable, stream_output: bool, priority: float = 1.0, measure: bool = True) -> Callable:
+        # Streaming calls count towards the limit, but their duration says little about how loaded we are.
+        def enter(request) -> float:
+            return self.acquire(priority)
+
+        def leave(start: float, result):
+            self.release(start if measure else None)
+
+        return wrap_calls(func, stream_output, enter, leave)
+
+
+class TrackingExecutor(ServerExecutor):
+    """
+    Takes a place under the admission controller's limit for each call as gRPC hands it to the pool, before it waits
+    for a thread, and tells the controller about it when the call runs.
+    """
+
+    def __init__(self, controller: AdmissionController, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.controller = controller
+
+    def submit(self, fn, *args, **kwargs):
+        controller = self.controller
+        arrived = time.perf_counter()
+        load = controller.reserve()
+
+        def run():
+            arrival = controller.arrival
+            arrival.time, arrival.load, arrival.claimed = arrived, load, False
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                arrival.time = None
+                # Cancelled calls never reach their method, and grpc.aio hands each step of a streaming method to the
+                # pool on its own, so give back places nobody claimed.
+                if load >= 0 and not arrival.claimed:
+                    controller.release()
+
+        try:
+            return super().submit(run)
+        except BaseException:
+            if load >= 0:
+                controller.release()
+            raise
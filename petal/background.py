@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional
+
+
+def wall_clock_offset() -> float:
+    """
+    What to add to a `time.perf_counter()` reading to get seconds since the epoch. Calls are timed with perf_counter,
+    which is cheaper than asking for the time of day, and their records converted once they are written out.
+    """
+    return time.time() - time.perf_counter()
+
+
+class BackgroundBuffer:
+    """
+    A bounded buffer of records that a background thread hands to `consume` in batches, at least every
+    `flush_interval` seconds. Adding a record never blocks: when the buffer is full the record is dropped and counted.
+    """
+
+    def __init__(self, consume: Callable[[List], None], capacity: int = 65536, batch_size: int = 1024,
+                 flush_interval: float = 1.0, name: str = 'petal-background'):
+        self.consume = consume
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        # Wake the thread early once there is a batch to hand over, or the buffer is getting full.
+        self.threshold = min(batch_size, capacity // 2)
+        # deque appends and pops are atomic, so adding a record and consuming it need no lock.
+        self.records: Deque = deque()
+        # Counted without a lock, which costs more than the rest of adding a record. An increment may very rarely be
+        # lost when two threads drop a record at once.
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, record):
+        length = len(self.records)
+        if length >= self.capacity:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if length + 1 == self.threshold:
+            self.wake.set()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Hand over the remaining records and stop the thread.
+        """
+        if not self.running:
+            return
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        while self.records:
+            batch = []
+            while self.records and len(batch) < self.batch_size:
+                batch.append(self.records.popleft())
+            self.consume(batch)
@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Any
+
+import grpc
+
+from .coalesce import RecordingContext, AsyncRecordingContext, MAX_WAIT
+
+
+class PendingCall:
+    def __init__(self, request, context_object):
+        self.request = request
+        self.context_object = context_object
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.abandoned = False
+        self.batch: Optional[List['PendingCall']] = None
+        self.response = None
+        self.recording_context: Optional[RecordingContext] = None
+
+
+def set_batch_error(context_object, details: str):
+    context_object.set_code(grpc.StatusCode.INTERNAL)
+    context_object.set_details(details)
+
+
+class Batcher:
+    """
+    Gathers concurrent unary calls into lists of up to `batch_size` requests, waiting at most `max_wait` seconds
+    after the first one arrives, and calls a list dispatcher once for each batch.
+
+    A background thread only collects the batches. Each batch is run on the thread of one of the callers
+    waiting for it, so several batches can be in flight at once.
+    """
+
+    def __init__(self, dispatcher: Callable, batch_size: int, max_wait: float):
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue: 'queue.Queue[PendingCall]' = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def __call__(self, request, context_object):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.collect, name='petal-batcher', daemon=True)
+                    self.thread.start()
+
+        call = PendingCall(request, context_object)
+        self.queue.put(call)
+        if not self.wait(call):
+            context_object.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+            context_object.set_details('Deadline exceeded waiting for a batch')
+            return None
+
+        if call.batch is not None:
+            self.run(call.batch)
+
+        call.recording_context.apply(context_object)
+        return call.response
+
+    def wait(self, call: PendingCall) -> bool:
+        while not call.event.is_set():
+            remaining = call.context_object.time_remaining()
+            if remaining is not None and remaining <= 0:
+                with call.lock:
+                    # Once we have been given a batch to run, the other callers rely on us to run it.
+                    if call.batch is None:
+                        call.abandoned = True
+                        return False
+                break
+            call.event.wait(min(remaining, MAX_WAIT) if remaining is not None else MAX_WAIT)
+        return True
+
+    def collect(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.hand_off(batch)
+
+    def hand_off(self, batch: List[PendingCall]):
+        for call in batch:
+            with call.lock:
+                if call.abandoned:
+                    continue
+                call.batch = [call for call in batch if not call.abandoned]
+            call.event.set()
+            return
+
+    def run(self, batch: List[PendingCall]):
+        recording_context = RecordingContext(batch[0].context_object)
+        responses = self.dispatcher([call.request for call in batch], recording_context)
+        if responses is not None and len(responses) != len(batch):
+            set_batch_error(recording_context, f'Batch method returned {len(responses)} responses '
+                                               f'for {len(batch)} requests')
+            responses = None
+
+        for index, call in enumerate(batch):
+            call.recording_context = recording_context
+            call.response = responses[index] if responses is not None else None
+            call.event.set()
+
+
+class AsyncBatcher:
+    def __init__(self, dispatcher: Callable, batch_size: int, max_wait: float):
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue: Optional[asyncio.Queue] = None
+
+    async def __call__(self, request, context_object):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            asyncio.ensure_future(self.collect())
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((request, context_object, future))
+        try:
+            recording_context, response = await asyncio.wait_for(asyncio.shield(future),
+                                                                   context_object.time_remaining())
+        except asyncio.TimeoutError:
+            await context_object.abort(grpc.StatusCode.DEADLINE_EXCEEDED, 'Deadline exceeded waiting for a batch')
+
+        if recording_context.code is not None and response is None:
+            await context_object.abort(recording_context.code, recording_context.details or '')
+        recording_context.apply(context_object)
+        return response
+
+    async def collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch: List[Any]):
+        recording_context = AsyncRecordingContext(batch[0][1])
+        try:
+            responses = await self.dispatcher([request for request, _, _ in batch], recording_context)
+        except grpc.aio.AbortError:
+            responses = None
+        if responses is not None and len(responses) != len(batch):
+            set_batch_error(recording_context, f'Batch method returned {len(responses)} responses '
+                                               f'for {len(batch)} requests')
+            responses = None
+
+        for index, (_, _, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((recording_context, responses[index] if responses is not None else None))
+
+
+def batch_dispatcher(dispatcher: Callable, batch_size: int, max_wait_ms: float, is_async: bool) -> Callable:
+    batcher = (AsyncBatcher if is_async else Batcher)(dispatcher, batch_size, max_wait_ms / 1000)
+    if is_async:
+        async def batched(request, context_object):
+            return await batcher(request, context_object)
+    else:
+        def batched(request, context_object):
+            return batcher(request, context_object)
+    return functools.wraps(dispatcher)(batched)
@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, List, Dict, Any, Optional, Iterable, Callable, TypeVar
+
+import grpc
+from google.protobuf.json_format import ParseDict
+
+from .dispatch import ServerExecutor
+from .grpc_services import GRPCMethod, GRPCService
+
+T = TypeVar('T')
+
+
+class MethodResult(NamedTuple):
+    name: str
+    requests: int
+    errors: int
+    rps: float
+    p50_ms: float
+    p99_ms: float
+    p999_ms: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = self._asdict()
+        del result['name']
+        return result
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def load_payloads(path: Optional[Path], service: GRPCService) -> Dict[str, List[Any]]:
+    """
+    Fixture files map method names to a list of requests, written as the JSON form of the request message.
+    Requests for client streaming methods are a list of messages. Methods without fixtures get an empty message.
+    """
+    fixtures = json.loads(path.read_text()) if path else {}
+    payloads = {}
+    for method in service.methods:
+        requests = fixtures.get(method.name) or [[{}] if method.input_stream else {}]
+        if method.input_stream:
+            payloads[method.name] = [[ParseDict(r, method.input_type()) for r in request] for request in requests]
+        else:
+            payloads[method.name] = [ParseDict(request, method.input_type()) for request in requests]
+    return payloads
+
+
+def create_callable(channel: grpc.Channel, service: GRPCService, method: GRPCMethod):
+    path = f'/{service.full_name}/{method.name}'
+    constructors = {
+        (False, False): channel.unary_unary,
+        (True, False): channel.stream_unary,
+        (False, True): channel.unary_stream,
+        (True, True): channel.stream_stream,
+    }
+    multi_callable = constructors[(method.input_stream, method.output_stream)](
+        path,
+        request_serializer=method.input_type.SerializeToString,
+        response_deserializer=method.output_type.FromString,
+    )
+
+    if method.input_stream and method.output_stream:
+        return lambda request: list(multi_callable(iter(request)))
+    if method.input_stream:
+        return lambda request: multi_callable(iter(request))
+    if method.output_stream:
+        return lambda request: list(multi_callable(request))
+    return multi_callable
+
+
+def bench_method(channel: grpc.Channel, service: GRPCService, method: GRPCMethod, payloads: List[Any],
+                 concurrency: int, duration: float) -> MethodResult:
+    call = create_callable(channel, service, method)
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(offset):
+        nonlocal errors
+        local_latencies, local_errors = [], 0
+        index = offset
+        while True:
+            start = time.perf_counter()
+            if start > deadline:
+                break
+            try:
+                call(payloads[index % len(payloads)])
+            except grpc.RpcError:
+                local_errors += 1
+            local_latencies.append(time.perf_counter() - start)
+            index += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return MethodResult(
+        name=method.name,
+        requests=len(latencies),
+        errors=errors,
+        rps=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        p999_ms=percentile(latencies, 0.999) * 1000,
+    )
+
+
+def serve_in_process(handler: grpc.GenericRpcHandler, threads: int, use_asyncio: bool,
+                     client: Callable[[int], T]) -> T:
+    """
+    Start a server on a random local port in this process and call `client` with the port, stopping the
+    server once it returns. grpc.aio servers are run on the main thread, with `client` run in another thread.
+    """
+    if not use_asyncio:
+        server = grpc.server(ServerExecutor(max_workers=threads))
+        server.add_generic_rpc_handlers((handler,))
+        port = server.add_insecure_port('127.0.0.1:0')
+        server.start()
+        try:
+            return client(port)
+        finally:
+            server.stop(grace=None)
+
+    import asyncio
+
+    async def serve():
+        server = grpc.aio.server(migration_thread_pool=ServerExecutor(max_workers=threads))
+        server.add_generic_rpc_handlers((handler,))
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, client, port)
+        finally:
+            await server.stop(grace=None)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    Percentage change of each metric against a previously recorded run, for methods present in both.
+    """
+    changes = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes[name] = {
+            key: (value - baseline[name][key]) / baseline[name][key] * 100
+            for key, value in result.items()
+            if key in ('rps', 'p50_ms', 'p99_ms', 'p999_ms') and baseline[name].get(key)
+        }
+    return changes
+
+
+def run_benchmark(handler: grpc.GenericRpcHandler, service: GRPCService, payloads: Dict[str, List[Any]],
+                  methods: Iterable[str], concurrency: int, duration: float, threads: int,
+                  use_asyncio: bool = False) -> List[MethodResult]:
+    def client(port):
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+            return [
+                bench_method(channel, service, method, payloads[method.name], concurrency, duration)
+                for method in service.methods
+                if method.name in methods
+            ]
+
+    return serve_in_process(handler, threads, use_asyncio, client)
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import re
+import subprocess
+from concurrent import futures
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, NamedTuple
+
+from .protoc_gen_extract_streaming import MANIFEST_NAME, MANIFEST_VERSION
+
+STATE_NAME = '.petal_build.json'
+STATE_VERSION = 1
+
+IMPORT_PATTERN = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', re.MULTILINE)
+
+
+class BuildPlan(NamedTuple):
+    # Proto file names relative to the root of the service's package, like "example/protobuf/greeter.proto".
+    keys: Dict[str, str]
+    compile: List[str]
+    removed: List[str]
+
+
+def output_names(proto_name: str) -> List[str]:
+    stem = proto_name[:-6].replace('-', '_')
+    return [f'{stem}_pb2.py', f'{stem}_pb2_grpc.py', f'{stem}_pb2.pyi']
+
+
+class DependencyHasher:
+    """
+    Hashes proto files together with everything they import, so a file's hash changes whenever it or anything it
+    depends on does. Imports are looked up in each of the roots in turn, like protoc's --proto_path.
+    """
+
+    def __init__(self, roots: List[Path]):
+        self.roots = roots
+        self.hashes: Dict[str, str] = {}
+
+    def find(self, name: str) -> Optional[Path]:
+        for root in self.roots:
+            path = root / name
+            if path.exists():
+                return path
+        return None
+
+    def __call__(self, name: str) -> str:
+        if name in self.hashes:
+            return self.hashes[name]
+        # protoc rejects import cycles, but don't recurse forever before it gets the chance.
+        self.hashes[name] = ''
+
+        digest = hashlib.sha256(name.encode())
+        path = self.find(name)
+        if path is not None:
+            # Files that can't be found are compiled into grpc_tools, so only change with its version.
+            content = path.read_bytes()
+            digest.update(content)
+            for imported in IMPORT_PATTERN.findall(content.decode('utf-8', 'replace')):
+                digest.update(self(imported).encode())
+
+        self.hashes[name] = digest.hexdigest()
+        return self.hashes[name]
+
+
+def read_state(proto_directory: Path) -> Optional[dict]:
+    path = proto_directory / STATE_NAME
+    if not path.exists():
+        return None
+    state = json.loads(path.read_text())
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def write_state(proto_directory: Path, arguments: List[str], files: Dict[str, dict]):
+    (proto_directory / STATE_NAME).write_text(json.dumps({
+        'version': STATE_VERSION,
+        'arguments': arguments,
+        'files': files,
+    }, indent=1, sort_keys=True))
+
+
+def plan_build(root: Path, proto_directory: Path, includes: List[Path], arguments: List[str],
+               state: Optional[dict]) -> BuildPlan:
+    hasher = DependencyHasher([root, *includes])
+    names = sorted(str(path.relative_to(root)) for path in proto_directory.glob('*.proto'))
+    keys = {name: hasher(name) for name in names}
+
+    if state is None or state['arguments'] != arguments:
+        return BuildPlan(keys=keys, compile=names, removed=[])
+
+    built = state['files']
+    compile = [
+        name for name in names
+        if name not in built or built[name]['key'] != keys[name]
+        or not all((root / output).exists() for output in built[name]['outputs'])
+    ]
+    removed = sorted(set(built) - set(names))
+    return BuildPlan(keys=keys, compile=compile, removed=removed)
+
+
+def chunk(names: List[str], count: int) -> List[List[str]]:
+    return [chunk for chunk in (names[index::count] for index in range(count)) if chunk]
+
+
+def read_manifest(proto_directory: Path) -> Dict[str, dict]:
+    path = proto_directory / MANIFEST_NAME
+    return json.loads(path.read_text())['services'] if path.exists() else {}
+
+
+def merge_manifests(proto_directory: Path, replaced: List[str], fragments: List[Path]):
+    """
+    Each protoc run writes a manifest for the files it compiled. Services from files that were compiled again or
+    removed are replaced by the services in those manifests. Services that don't say which file they came from were
+    written before builds were incremental, and are dropped.
+    """
+    path = proto_directory / MANIFEST_NAME
+    services = {
+        name: service for name, service in read_manifest(proto_directory).items()
+        if 'proto' in service and service['proto'] not in replaced
+    }
+    for fragment in fragments:
+        if fragment.exists():
+            services.update(json.loads(fragment.read_text())['services'])
+            fragment.unlink()
+
+    if services:
+        path.write_text(json.dumps({'version': MANIFEST_VERSION, 'services': services},
+                                   sort_keys=True, separators=(',', ':')))
+    elif path.exists():
+        path.unlink()
+
+
+def build(root: Path, proto_directory: Path, includes: List[Path], protoc_arguments: Callable[[str], List[str]],
+          jobs: int, force: bool = False, echo: Callable[[str], None] = print) -> BuildPlan:
+    """
+    Compile the proto files that changed since the last build, or that import a file that did, spread across up
+    to `jobs` protoc processes. `protoc_arguments` returns the arguments for a run writing its manifest to the
+    file it is given.
+    """
+    arguments = protoc_arguments(MANIFEST_NAME)
+    state = None if force else read_state(proto_directory)
+    if state is not None and not all('proto' in service for service in read_manifest(proto_directory).values()):
+        # The manifest can't say which services came from which file, so it has to be written again in full.
+        state = None
+    plan = plan_build(root, proto_directory, includes, arguments, state)
+    built = {} if state is None else dict(state['files'])
+
+    if state is None:
+        echo('Clearing output directory...')
+        keep = set(proto_directory.glob('*.proto')) | {proto_directory / '__init__.py'}
+        for path in proto_directory.iterdir():
+            if path.is_file() and path not in keep:
+                path.unlink()
+
+    for name in plan.removed:
+        for output in built.pop(name)['outputs']:
+            if (root / output).exists():
+                echo(f'Removing {output}')
+                (root / output).unlink()
+
+    chunks = chunk(plan.compile, jobs)
+    fragments = [proto_directory / f'{MANIFEST_NAME}.{index}' for index in range(len(chunks))]
+    failed, compiled, merged = [], [], []
+    with futures.ThreadPoolExecutor(max_workers=max(len(chunks), 1)) as executor:
+        runs = {
+            executor.submit(subprocess.run, protoc_arguments(fragment.name) + names): (fragment, names)
+            for fragment, names in zip(fragments, chunks)
+        }
+        for run in futures.as_completed(runs):
+            fragment, names = runs[run]
+            if run.result().returncode != 0:
+                # Keep the services these files had in the manifest, they are compiled again on the next build.
+                failed.extend(names)
+                if fragment.exists():
+                    fragment.unlink()
+                continue
+            compiled.extend(names)
+            merged.append(fragment)
+            for name in names:
+                built[name] = {
+                    'key': plan.keys[name],
+                    'outputs': [output for output in output_names(name) if (root / output).exists()],
+                }
+
+    merge_manifests(proto_directory, compiled + plan.removed, merged)
+    write_state(proto_directory, arguments, built)
+    if failed:
+        raise subprocess.CalledProcessError(1, f'protoc {" ".join(sorted(failed))}')
+    return plan
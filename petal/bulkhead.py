@@ -0,0 +1,181 @@
+import asyncio
+import json
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Optional, NamedTuple, Callable, Deque, Dict
+
+from . import exceptions
+from .dispatch import time_remaining, wrap_calls
+
+
+class BulkheadStats(NamedTuple):
+    name: str
+    max_concurrent: Optional[int]
+    max_queue: int
+    active: int
+    queued: int
+    rejected: int
+    completed: int
+
+
+class ServerThreads:
+    """
+    The thread pool of a server, shared by the bulkheads of every service it serves. `held` counts the calls
+    running or waiting inside any of them.
+    """
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.held = 0
+        self.lock = threading.Lock()
+
+    def hold(self, queueing: bool) -> bool:
+        with self.lock:
+            # A synchronous call only waits for a slot if a thread is still left for calls outside the bulkheads.
+            if queueing and self.held + 1 >= self.threads:
+                return False
+            self.held += 1
+            return True
+
+    def let_go(self):
+        with self.lock:
+            self.held -= 1
+
+
+class Waiter:
+    __slots__ = ('granted', 'event', 'loop', 'future')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.set_result)
+
+    def set_result(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Bulkhead:
+    """
+    Limits how many calls to a method, or a group of methods, can run at once so they cannot take every thread
+    from the rest of the service. Up to `max_queue` calls wait for a slot in the order they arrived, and any more
+    are rejected straight away with `ResourceExhausted`. Waiting calls fail with `DeadlineExceeded` if their
+    deadline passes first.
+
+    Synchronous calls wait on one of the server's threads. Once `threads` is set to the server's `ServerThreads`,
+    they are rejected rather than queued when the calls in this and every other bulkhead sharing it would hold all of
+    its threads, whatever `max_queue` says.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, max_queue: int = 0, name: str = None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.threads: Optional[ServerThreads] = None
+        self.lock = threading.Lock()
+        self.waiters: Deque[Waiter] = deque()
+        self.active = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def configure(self, max_concurrent: Optional[int], max_queue: int = 0):
+        with self.lock:
+            self.max_concurrent = max_concurrent
+            self.max_queue = max_queue
+
+    def try_acquire(self, loop: asyncio.AbstractEventLoop = None) -> Optional[Waiter]:
+        threads = self.threads
+        with self.lock:
+            if self.max_concurrent is None or (self.active < self.max_concurrent and not self.waiters):
+                self.active += 1
+                if threads is not None:
+                    threads.hold(queueing=False)
+                return None
+            if len(self.waiters) >= self.max_queue or (threads is not None and not threads.hold(loop is None)):
+                self.rejected += 1
+                raise exceptions.ResourceExhausted(f'Too many concurrent calls to {self.name}')
+            waiter = Waiter(loop)
+            self.waiters.append(waiter)
+            return waiter
+
+    def give_up(self, waiter: Waiter) -> bool:
+        with self.lock:
+            if waiter.granted:
+                return False
+            self.waiters.remove(waiter)
+            if self.threads is not None:
+                self.threads.let_go()
+            return True
+
+    def acquire(self):
+        waiter = self.try_acquire()
+        if waiter is not None and not waiter.event.wait(time_remaining()) and self.give_up(waiter):
+            raise exceptions.DeadlineExceeded(f'Deadline exceeded waiting for {self.name}')
+
+    async def acquire_async(self):
+        waiter = self.try_acquire(asyncio.get_event_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.future, time_remaining())
+        except asyncio.TimeoutError:
+            if self.give_up(waiter):
+                raise exceptions.DeadlineExceeded(f'Deadline exceeded waiting for {self.name}')
+        except BaseException:
+            # Cancelled while waiting. If the slot was handed over in the meantime, pass it on rather than lose it.
+            if not self.give_up(waiter):
+                self.hand_over()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.completed += 1
+        self.hand_over()
+
+    def hand_over(self):
+        with self.lock:
+            if self.threads is not None:
+                self.threads.let_go()
+            if self.waiters:
+                # Hand our slot straight to the next waiter.
+                waiter = self.waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+
+    def stats(self) -> BulkheadStats:
+        with self.lock:
+            return BulkheadStats(name=self.name, max_concurrent=self.max_concurrent, max_queue=self.max_queue,
+                                 active=self.active, queued=len(self.waiters), rejected=self.rejected,
+                                 completed=self.completed)
+
+    def wrap(self, func: Callable, stream_output: bool) -> Callable:
+        def enter(request):
+            self.acquire()
+
+        async def enter_async(request):
+            await self.acquire_async()
+
+        def leave(state, result):
+            self.release()
+
+        return wrap_calls(func, stream_output, enter, leave, enter_async)
+
+
+def load_bulkhead_config(path: Path) -> Dict[str, dict]:
+    """
+    Bulkhead config files map bulkhead names to their settings:
+    {"slow": {"max_concurrent": 4, "max_queue": 16}}
+    """
+    return json.loads(path.read_text())
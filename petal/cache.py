@@ -0,0 +1,102 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Callable, Tuple
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    entries: int
+    bytes: int
+
+
+class ResponseCache:
+    """
+    A LRU cache of serialized responses, keyed on the serialized request. Entries are evicted once there are more
+    than `max_entries` of them, once the keys and values take up more than `max_bytes` or after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: 'OrderedDict[bytes, Tuple[bytes, float]]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires and expires < time.monotonic():
+                self._remove(key, value)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: bytes, value: bytes):
+        entry_size = len(key) + len(value)
+        if self.max_bytes is not None and entry_size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            existing = self.entries.pop(key, None)
+            if existing is not None:
+                self.size -= len(key) + len(existing[0])
+            self.entries[key] = (value, expires)
+            self.size += entry_size
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                evicted_key, (evicted_value, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted_key) + len(evicted_value)
+                self.evictions += 1
+
+    def _remove(self, key: bytes, value: bytes):
+        del self.entries[key]
+        self.size -= len(key) + len(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> CacheStats:
+        with self.lock:
+            return CacheStats(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                              expirations=self.expirations, entries=len(self.entries), bytes=self.size)
+
+    def wrap(self, dispatcher: Callable, is_async: bool) -> Callable:
+        """
+        Wrap a serialized dispatcher so a hit skips deserialization, the method and serialization entirely.
+        """
+        if is_async:
+            async def cached(request_bytes, context_object):
+                response_bytes = self.get(request_bytes)
+                if response_bytes is None:
+                    response_bytes = await dispatcher(request_bytes, context_object)
+                    if response_bytes is not None:
+                        self.set(request_bytes, response_bytes)
+                return response_bytes
+        else:
+            def cached(request_bytes, context_object):
+                response_bytes = self.get(request_bytes)
+                if response_bytes is None:
+                    response_bytes = dispatcher(request_bytes, context_object)
+                    if response_bytes is not None:
+                        self.set(request_bytes, response_bytes)
+                return response_bytes
+
+        return functools.wraps(dispatcher)(cached)
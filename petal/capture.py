@@ -0,0 +1,229 @@
+import inspect
+import os
+import random
+import struct
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Iterator, Union, BinaryIO
+
+import grpc
+
+from .background import BackgroundBuffer, wall_clock_offset
+from .dispatch import wrap_calls
+from .log import logger
+from .metrics import status_code
+
+MAGIC = b'PETALCAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sB')
+RECORD_LENGTH = struct.Struct('<I')
+CALL_HEADER = struct.Struct('<ddBBHHI')
+STREAM_INPUT = 0x01
+STREAM_OUTPUT = 0x02
+SHORT = struct.Struct('<H')
+LONG = struct.Struct('<I')
+
+CODES = {code.value[0]: code for code in grpc.StatusCode}
+
+
+class CapturedCall(NamedTuple):
+    method: str
+    # Seconds since the epoch when the call arrived, and how long it took to handle.
+    start: float
+    duration: float
+    code: grpc.StatusCode
+    stream_input: bool
+    stream_output: bool
+    metadata: Tuple[Tuple[str, Union[str, bytes]], ...]
+    # The serialized requests, one for unary methods.
+    requests: List[bytes]
+
+
+class CaptureStats(NamedTuple):
+    written: int
+    dropped: int
+    buffered: int
+
+
+def serialize(message) -> bytes:
+    return message if isinstance(message, bytes) else message.SerializeToString()
+
+
+class Capture:
+    """
+    Records a sample of calls to a binary file to be replayed later with `petal replay`. Sampled calls serialize
+    their requests as they arrive, before the method can change them, and put them in a bounded buffer that a
+    background thread writes out, so capturing never blocks a call. When the buffer is full new calls are dropped
+    and counted.
+
+    Each record holds the method, when the call arrived and how long it took, its status, its metadata and its
+    serialized requests. Up to `max_messages` requests of a client streaming call are kept.
+    """
+
+    def __init__(self, path: Union[str, Path], rate: float = 0.01, sample_rates: Dict[str, float] = None,
+                 capacity: int = 16384, batch_size: int = 256, flush_interval: float = 1.0, max_messages: int = 1000):
+        self.path = Path(path)
+        self.rate = rate
+        self.sample_rates = sample_rates or {}
+        self.max_messages = max_messages
+        self.buffer = BackgroundBuffer(self.write_batch, capacity, batch_size, flush_interval, 'petal-capture')
+        self.written = 0
+        self.failed = 0
+        self.failing = False
+        self.fd: Optional[int] = None
+
+    def wrap(self, dispatcher: Callable, path: str, stream_input: bool, stream_output: bool) -> Callable:
+        """
+        Wrap the outermost dispatcher of a method to capture a sample of its calls. `path` is the method's gRPC path,
+        like "/helloworld.Greeter/SayHello".
+        """
+        rate = self.sample_rates.get(path.rsplit('/', 1)[-1], self.rate)
+        if rate <= 0:
+            return dispatcher
+        sampled = rate < 1
+        add, perf_counter, max_messages = self.buffer.add, time.perf_counter, self.max_messages
+        flags = (STREAM_INPUT if stream_input else 0) | (STREAM_OUTPUT if stream_output else 0)
+
+        def enter(request, context_object) -> Optional[tuple]:
+            if sampled and random.random() >= rate:
+                return None
+            return perf_counter(), [] if stream_input else [serialize(request)], context_object
+
+        def leave(state: Optional[tuple], result):
+            if state is None:
+                return
+            start, requests, context_object = state
+            end = perf_counter()
+            add((path, flags, start, end - start, status_code(context_object, result),
+                 context_object.invocation_metadata(), requests))
+
+        def keep(requests, kept: list):
+            for request in requests:
+                if len(kept) < max_messages:
+                    kept.append(serialize(request))
+                yield request
+
+        async def async_keep(requests, kept: list):
+            async for request in requests:
+                if len(kept) < max_messages:
+                    kept.append(serialize(request))
+                yield request
+
+        is_async = inspect.iscoroutinefunction(dispatcher) or inspect.isasyncgenfunction(dispatcher)
+
+        def requests(state: Optional[tuple], stream):
+            if state is None:
+                return stream
+            return (async_keep if is_async else keep)(stream, state[1])
+
+        return wrap_calls(dispatcher, stream_output, enter, leave, requests=requests if stream_input else None)
+
+    def stats(self) -> CaptureStats:
+        return CaptureStats(written=self.written, dropped=self.buffer.dropped + self.failed,
+                            buffered=len(self.buffer))
+
+    def start(self):
+        """
+        Start the writer thread, appending to the capture file. Forked worker processes should each capture to
+        their own file.
+        """
+        if self.buffer.running:
+            return
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size == 0:
+            os.write(self.fd, FILE_HEADER.pack(MAGIC, VERSION))
+        self.buffer.start()
+
+    def stop(self):
+        """
+        Write the remaining calls and stop the writer thread.
+        """
+        if not self.buffer.running:
+            return
+        self.buffer.stop()
+        os.close(self.fd)
+        self.fd = None
+
+    def write_batch(self, batch: List[tuple]):
+        offset = wall_clock_offset()
+        data = b''.join(encode_call(path, flags, start + offset, duration, code, metadata, requests)
+                        for path, flags, start, duration, code, metadata, requests in batch)
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            self.failed += len(batch)
+            if not self.failing:
+                logger.warning(f'Could not write captured calls to {self.path}, dropping them: {e}')
+            self.failing = True
+            return
+        self.failing = False
+        self.written += len(batch)
+
+
+def encode_call(path: str, flags: int, start: float, duration: float, code: grpc.StatusCode, metadata,
+                requests: List[bytes]) -> bytes:
+    parts = [path.encode()]
+    for key, value in metadata or ():
+        value = value if isinstance(value, bytes) else value.encode()
+        parts.append(SHORT.pack(len(key)) + key.encode())
+        parts.append(LONG.pack(len(value)) + value)
+    for data in requests:
+        parts.append(LONG.pack(len(data)) + data)
+    body = CALL_HEADER.pack(start, duration, code.value[0], flags, len(parts[0]), len(metadata or ()), len(requests))
+    body += b''.join(parts)
+    return RECORD_LENGTH.pack(len(body)) + body
+
+
+def decode_call(body: bytes) -> CapturedCall:
+    start, duration, code, flags, path_length, metadata_count, request_count = CALL_HEADER.unpack_from(body)
+    offset = CALL_HEADER.size
+    path = body[offset:offset + path_length].decode()
+    offset += path_length
+
+    metadata = []
+    for _ in range(metadata_count):
+        key_length, = SHORT.unpack_from(body, offset)
+        key = body[offset + SHORT.size:offset + SHORT.size + key_length].decode()
+        offset += SHORT.size + key_length
+        value_length, = LONG.unpack_from(body, offset)
+        value = body[offset + LONG.size:offset + LONG.size + value_length]
+        offset += LONG.size + value_length
+        # Binary metadata is sent as bytes, everything else as text.
+        metadata.append((key, value if key.endswith('-bin') else value.decode()))
+
+    requests = []
+    for _ in range(request_count):
+        length, = LONG.unpack_from(body, offset)
+        requests.append(body[offset + LONG.size:offset + LONG.size + length])
+        offset += LONG.size + length
+
+    return CapturedCall(method=path, start=start, duration=duration, code=CODES.get(code, grpc.StatusCode.UNKNOWN),
+                        stream_input=bool(flags & STREAM_INPUT), stream_output=bool(flags & STREAM_OUTPUT),
+                        metadata=tuple(metadata), requests=requests)
+
+
+def read_capture(path: Union[str, Path]) -> Iterator[CapturedCall]:
+    """
+    The calls recorded in a capture file, in the order they were written. A record cut short by the process
+    stopping mid-write ends the file.
+    """
+    with open(path, 'rb') as file:
+        yield from read_calls(file, str(path))
+
+
+def read_calls(file: BinaryIO, name: str) -> Iterator[CapturedCall]:
+    header = file.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        return
+    magic, version = FILE_HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{name} is not a petal capture file')
+    while True:
+        length = file.read(RECORD_LENGTH.size)
+        if len(length) < RECORD_LENGTH.size:
+            return
+        body = file.read(RECORD_LENGTH.unpack(length)[0])
+        if len(body) < RECORD_LENGTH.unpack(length)[0]:
+            return
+        yield decode_call(body)
@@ -0,0 +1,135 @@
+import functools
+import inspect
+from typing import Callable, Optional, Type
+
+from google.protobuf.descriptor import FieldDescriptor
+
+DEFAULT_CHUNK_BYTES = 64 * 1024
+# The most bytes a varint can take on the wire, for a negative 64 bit number.
+MAX_VARINT_BYTES = 10
+# Room for a packed field's own tag and length prefix.
+PACKED_OVERHEAD = 5 + 5
+FIXED_SIZES = {
+    FieldDescriptor.TYPE_BOOL: 1,
+    FieldDescriptor.TYPE_FIXED32: 4,
+    FieldDescriptor.TYPE_SFIXED32: 4,
+    FieldDescriptor.TYPE_FLOAT: 4,
+    FieldDescriptor.TYPE_FIXED64: 8,
+    FieldDescriptor.TYPE_SFIXED64: 8,
+    FieldDescriptor.TYPE_DOUBLE: 8,
+}
+ZIGZAG_TYPES = (FieldDescriptor.TYPE_SINT32, FieldDescriptor.TYPE_SINT64)
+
+
+def is_repeated(field: FieldDescriptor) -> bool:
+    # Newer protobuf releases replaced `label` with `is_repeated`.
+    repeated = getattr(field, 'is_repeated', None)
+    if repeated is not None:
+        return repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+def varint_size(value: int) -> int:
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+
+def find_chunk_field(chunk_type: Type, item_type: Type, name: Optional[str] = None) -> FieldDescriptor:
+    """
+    The repeated field of `chunk_type` that holds the items, `name` or else the only one holding `item_type` messages.
+    Raises ValueError if there is no such field.
+    """
+    fields = chunk_type.DESCRIPTOR.fields_by_name
+    if name is not None:
+        if name not in fields or not is_repeated(fields[name]):
+            raise ValueError(f'{chunk_type.__name__} has no repeated field {name}')
+        return fields[name]
+
+    item_descriptor = getattr(item_type, 'DESCRIPTOR', None)
+    candidates = [
+        field for field in fields.values()
+        if is_repeated(field) and field.message_type is not None and item_descriptor is not None
+        and field.message_type.full_name == item_descriptor.full_name
+    ]
+    if len(candidates) != 1:
+        raise ValueError(f'{chunk_type.__name__} needs exactly one repeated {item_type.__name__} field to hold the '
+                         f'items, use chunk_field to pick one')
+    return candidates[0]
+
+
+def item_sizer(field: FieldDescriptor) -> Callable:
+    # An upper bound of the bytes each item adds to a chunk, so chunks never go over their limit. Packed numbers are
+    # counted with a tag each, which they don't have, but the chunk's limit is also lowered by PACKED_OVERHEAD.
+    tag = varint_size(field.number << 3)
+    if field.message_type is not None:
+        def size(item) -> int:
+            length = item.ByteSize()
+            return tag + varint_size(length) + length
+    elif field.type == FieldDescriptor.TYPE_STRING:
+        def size(item) -> int:
+            length = len(item.encode())
+            return tag + varint_size(length) + length
+    elif field.type == FieldDescriptor.TYPE_BYTES:
+        def size(item) -> int:
+            return tag + varint_size(len(item)) + len(item)
+    elif field.type in FIXED_SIZES:
+        fixed = tag + FIXED_SIZES[field.type]
+
+        def size(item) -> int:
+            return fixed
+    elif field.type in ZIGZAG_TYPES:
+        def size(item) -> int:
+            return tag + varint_size(abs(item) * 2)
+    else:
+        def size(item) -> int:
+            return tag + (varint_size(item) if item >= 0 else MAX_VARINT_BYTES)
+    return size
+
+
+def chunk_responses(func: Callable, chunk_type: Type, field: FieldDescriptor, max_bytes: int) -> Callable:
+    """
+    Wrap a method returning an iterator of items into one streaming `chunk_type` messages, each holding as many items
+    in `field` as fit in `max_bytes`. An item bigger than that is sent in a chunk of its own.
+
+    Items are only pulled from the method as chunks are sent, and gRPC only asks for the next response once the last
+    one has been handed to the transport, so a slow client pauses the method rather than letting chunks pile up.
+    """
+    name = field.name
+    size = item_sizer(field)
+    if field.message_type is None and field.type not in (FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES):
+        max_bytes -= PACKED_OVERHEAD
+
+    def pack(items: list):
+        chunk = chunk_type()
+        getattr(chunk, name).extend(items)
+        return chunk
+
+    if inspect.isasyncgenfunction(func):
+        async def chunked(request):
+            items, total = [], 0
+            async for item in func(request):
+                item_bytes = size(item)
+                if items and total + item_bytes > max_bytes:
+                    yield pack(items)
+                    items, total = [], 0
+                items.append(item)
+                total += item_bytes
+            if items:
+                yield pack(items)
+    else:
+        def chunked(request):
+            items, total = [], 0
+            for item in func(request):
+                item_bytes = size(item)
+                if items and total + item_bytes > max_bytes:
+                    yield pack(items)
+                    items, total = [], 0
+                items.append(item)
+                total += item_bytes
+            if items:
+                yield pack(items)
+
+    return functools.wraps(func)(chunked)
@@ -1,19 +1,36 @@
+import asyncio
+import json
+import threading
 import time
-from concurrent import futures
+from typing import Callable, Dict, List
 
 import click
 import os
 from pathlib import Path
 import importlib
 import sys
+import signal
 import subprocess
 
 import grpc
 import pkg_resources
 
-from petal import Service
+from petal import Service, ServerThreads, load_grpc_service
+from petal.bench import load_payloads, run_benchmark, compare, MethodResult
+from petal.build import build as build_protobufs, BuildPlan
 from petal.log import logger
-from petal.exceptions import InitializationException
+from petal.metrics import Metrics
+from petal.profiler import Profiler
+from petal.protoc_gen_extract_streaming import MANIFEST_NAME
+from petal.reload import ReloadingHandler, Watcher, is_generated, affected_modules
+from petal.access_log import AccessLog
+from petal.tracing import Tracer, FileExporter
+from petal.capture import Capture, read_capture
+from petal.replay import replay as replay_calls
+from petal.admission import AdmissionController, GradientLimit, AIMDLimit
+from petal.dispatch import ServerExecutor
+from petal.exceptions import InitializationException, ResourceExhausted, Unavailable
+from petal.workers import Supervisor, worker_count
 
 
 @click.group()
@@ -21,54 +38,489 @@ def cli():
     pass
 
 
-@cli.command()
-@click.argument('module')
-@click.option('--bind', default='0.0.0.0:50051')
-@click.option('--shutdown-grace', default=10)
-@click.option('--threads', default=10, type=int)
-def run(module, bind, shutdown_grace, threads):
-    sys.path.append(os.getcwd())
+class StartupTimer:
+    """
+    Records how long each phase of starting up took, to be logged once the server is listening.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.last = time.perf_counter()
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, action: str = 'Started') -> str:
+        # Phases repeated for each of several services are reported together.
+        durations = {}
+        for phase, duration in self.phases:
+            durations[phase] = durations.get(phase, 0) + duration
+        total = sum(durations.values())
+        breakdown = ', '.join(f'{phase} {duration * 1000:.0f}ms' for phase, duration in durations.items())
+        return f'{action} in {total * 1000:.0f}ms ({breakdown})'
+
+
+def load_service(module, timer: StartupTimer = None) -> Service:
+    # "package.module:name" loads a Service not called `service`.
+    module, _, attribute = module.partition(':')
+    attribute = attribute or 'service'
+    timer = timer or StartupTimer()
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
     module_object = importlib.import_module(module)
+    timer.mark('import')
 
     try:
-        app: Service = module_object.service
+        app: Service = getattr(module_object, attribute)
     except AttributeError:
-        raise click.UsageError(f'Could not find {module}.service')
+        raise click.UsageError(f'Could not find {module}.{attribute}')
 
     try:
         app.validate_service()
     except InitializationException as e:
         raise click.ClickException(str(e)) from e
+    timer.mark('validate')
+
+    return app
+
+
+@cli.command()
+@click.argument('modules', nargs=-1, required=True)
+@click.option('--bind', default='0.0.0.0:50051')
+@click.option('--shutdown-grace', default=10)
+@click.option('--threads', default=10, type=int)
+@click.option('--executors', type=click.Choice(['shared', 'separate']), default='shared',
+              help='With several services, share one pool of --threads, or give each service its own --threads.')
+@click.option('--asyncio', 'use_asyncio', is_flag=True, default=False,
+              help='Serve on a grpc.aio server. Synchronous methods run in the --threads pool.')
+@click.option('--workers', default=None,
+              help='Fork this many worker processes sharing the port with SO_REUSEPORT, or "auto" for one per core.')
+@click.option('--bulkheads', type=click.Path(exists=True, dir_okay=False),
+              help='JSON file mapping bulkhead names to their max_concurrent and max_queue limits.')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve Prometheus metrics on this port. Each worker started with --workers uses the next port.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Start the sampling profiler right away. Sending SIGUSR2 toggles it at any time.')
+@click.option('--profile-dir', default='profiles', type=click.Path(file_okay=False),
+              help='Directory the per-method collapsed stack files are written to when profiling stops.')
+@click.option('--profile-rate', default=100, type=float, help='Samples per second.')
+@click.option('--admission-control', type=click.Choice(['gradient', 'aimd']), default=None,
+              help='Reject calls over a concurrency limit adapted from the latency of recent calls.')
+@click.option('--reject-with', type=click.Choice(['resource-exhausted', 'unavailable']), default='resource-exhausted',
+              help='Status code for calls rejected by --admission-control.')
+@click.option('--access-log', type=click.Path(dir_okay=False, allow_dash=True), default=None,
+              help='Append a JSON line for every call to this file, or to stdout with "-".')
+@click.option('--access-log-rate', type=float, default=1.0, help='Fraction of calls to record in the access log.')
+@click.option('--access-log-sample', multiple=True, metavar='METHOD=RATE',
+              help='Fraction of the calls to one method to record, overriding --access-log-rate.')
+@click.option('--trace-to', type=click.Path(dir_okay=False), default=None,
+              help='Trace calls, appending the spans to this file as JSON lines.')
+@click.option('--trace-rate', type=float, default=0.01,
+              help='Fraction of calls starting a new trace to sample. Calls from traced callers follow their decision.')
+@click.option('--capture', 'capture_path', type=click.Path(dir_okay=False), default=None,
+              help='Record a sample of calls to this file, to send again with "petal replay". '
+                   'Each worker records to its own file, with its number appended.')
+@click.option('--capture-rate', type=float, default=0.01, help='Fraction of calls to capture.')
+@click.option('--reload', is_flag=True, default=False,
+              help='Reload the service when its code changes, and rebuild it when its .proto files change.')
+def run(modules, bind, shutdown_grace, threads, executors, use_asyncio, workers, bulkheads, metrics_port,
+        profile, profile_dir, profile_rate, admission_control, reject_with, access_log, access_log_rate,
+        access_log_sample, trace_to, trace_rate, capture_path, capture_rate, reload):
+    if reload and (workers is not None or metrics_port is not None):
+        raise click.UsageError('--reload cannot be used with --workers or --metrics-port')
+    if reload and len(modules) > 1:
+        raise click.UsageError('--reload can only be used with a single service')
+
+    hosting_several = len(modules) > 1
+    # Services on the same server share the process, so they share its admission limit and metrics endpoint.
+    admission = None
+    if admission_control is not None:
+        limit = GradientLimit() if admission_control == 'gradient' else AIMDLimit()
+        rejection = ResourceExhausted if reject_with == 'resource-exhausted' else Unavailable
+        admission = AdmissionController(limit, rejection=rejection)
+    metrics = Metrics() if metrics_port is not None else None
+    tracer = Tracer(FileExporter(trace_to), trace_rate) if trace_to is not None else None
+    capture = Capture(capture_path, capture_rate) if capture_path is not None else None
+    calls_log = None
+    if access_log is not None:
+        calls_log = AccessLog(access_log, sample_rates=parse_sample_rates(access_log_sample),
+                              default_rate=access_log_rate)
+
+    pool_threads = threads
+    if hosting_several and executors == 'separate':
+        pool_threads = 2 * threads * len(modules)
+    server_threads = ServerThreads(pool_threads)
+
+    def configure(app: Service, module: str):
+        if hosting_several:
+            app.name_prefix = f'{load_grpc_service(app.package, app.service_name).full_name}.'
+            if executors == 'separate':
+                # Calls waiting for their service's slots hold a thread too, hence twice the threads per service.
+                app.limit_concurrency(threads, threads)
+        if admission is not None:
+            app.enable_admission_control(admission)
+        if bulkheads:
+            app.load_bulkheads(Path(bulkheads))
+        if metrics is not None:
+            app.enable_metrics(metrics)
+        if calls_log is not None:
+            app.enable_access_log(calls_log)
+        if tracer is not None:
+            app.enable_tracing(tracer)
+        if capture is not None:
+            app.enable_capture(capture)
+        app.fit_bulkheads(server_threads)
+        for method in app.rpc_methods:
+            if method.batched and not method.is_async and method.batch_size > pool_threads:
+                # Every call waiting for a synchronous batch holds a thread, so batches never get any bigger.
+                logger.warning(f'{method.python_name} has a batch_size of {method.batch_size}, but only '
+                               f'{pool_threads} threads to wait for a batch in')
+
+        if app.is_async and not use_asyncio:
+            raise click.UsageError(f'{module} has async methods, please run it with --asyncio')
+
+    timer = StartupTimer()
+    apps = [load_service(module, timer) for module in modules]
+    full_names = [load_grpc_service(app.package, app.service_name).full_name for app in apps]
+    duplicates = {name for name in full_names if full_names.count(name) > 1}
+    if duplicates:
+        raise click.UsageError(f'{", ".join(sorted(duplicates))} would be served more than once')
+    for app, module in zip(apps, modules):
+        configure(app, module)
+
+    serve_function = serve_asyncio if use_asyncio else serve
+
+    def start_profiler():
+        methods = {}
+        for app in apps:
+            methods.update(app.profiled_methods())
+        profiler = Profiler(methods, Path(profile_dir), profile_rate)
+        profiler.listen(signal.SIGUSR2)
+        if profile:
+            profiler.start()
+        return profiler
+
+    def create_handlers():
+        return tuple(app.create_service_handler() for app in apps)
+
+    timer.mark('configure')
+
+    if workers is None:
+        # Stop gracefully on SIGTERM too, like the workers do.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        if metrics is not None:
+            metrics.serve(metrics_port)
+            logger.info(f'Serving metrics on port {metrics_port}')
+        profiler = start_profiler()
+        if calls_log is not None:
+            calls_log.start()
+        if tracer is not None:
+            tracer.start()
+        if capture is not None:
+            capture.start()
+        handlers = create_handlers()
+        timer.mark('handlers')
+        restarting = threading.Event()
+        if reload:
+            handlers = (ReloadingHandler(handlers[0]),)
+            threading.Thread(target=reload_forever, args=(modules[0], apps, handlers[0], configure, restarting),
+                             daemon=True).start()
+        serve_function(handlers, bind, shutdown_grace, pool_threads, timer=timer, admission=admission)
+        for app in apps:
+            app.stop_process_pools()
+        profiler.stop()
+        if calls_log is not None:
+            calls_log.stop()
+        if tracer is not None:
+            tracer.stop()
+        if capture is not None:
+            capture.stop()
+        if restarting.is_set():
+            restart()
+        return
+
+    try:
+        worker_processes = worker_count(workers)
+    except ValueError:
+        raise click.BadParameter(f'{workers} is not a number or "auto"', param_hint='--workers')
+
+    # gRPC must not be started before forking, so each worker builds its own handler and server.
+    def worker(index):
+        worker_timer = StartupTimer()
+        if metrics is not None:
+            metrics.serve(metrics_port + index)
+            logger.info(f'Serving metrics on port {metrics_port + index}')
+        profiler = start_profiler()
+        if calls_log is not None:
+            calls_log.start()
+        if tracer is not None:
+            tracer.start()
+        if capture is not None:
+            capture.path = Path(f'{capture_path}.{index}')
+            capture.start()
+        handlers = create_handlers()
+        worker_timer.mark('handlers')
+        serve_function(handlers, bind, shutdown_grace, pool_threads, options=[('grpc.so_reuseport', 1)],
+                       timer=worker_timer, admission=admission)
+        for app in apps:
+            app.stop_process_pools()
+        profiler.stop()
+        if calls_log is not None:
+            calls_log.stop()
+        if tracer is not None:
+            tracer.stop()
+        if capture is not None:
+            capture.stop()
+
+    logger.info(timer.report())
+    logger.info(f'Starting {worker_processes} workers.')
+    Supervisor(worker, worker_processes).run()
+
+
+def parse_sample_rates(samples) -> Dict[str, float]:
+    rates = {}
+    for sample in samples:
+        method, _, rate = sample.partition('=')
+        try:
+            rates[method] = float(rate)
+        except ValueError:
+            raise click.BadParameter(f'{sample} is not METHOD=RATE', param_hint='--access-log-sample')
+    return rates
+
+
+def reload_forever(module: str, apps: List[Service], handler: ReloadingHandler,
+                   configure: Callable[[Service, str], None], restarting: threading.Event):
+    """
+    Reload the service in `apps` whenever its code changes, swapping it in the running server, which keeps its
+    socket open. When its protobufs change the process has to start again: `restarting` is set and the server
+    stopped like on SIGINT, so calls in flight finish and the buffered records are written before it does.
+    """
+    app = apps[0]
+    service_directory = Path(app.package.replace('.', '/'))
+    roots = [Path(sys.modules[module].__file__).parent, service_directory / 'protobuf']
+    watcher = Watcher(roots)
+    logger.info(f'Watching {", ".join(str(root) for root in roots)} for changes')
+
+    while True:
+        changed = watcher.wait()
+        timer = StartupTimer()
+        if any(path.suffix == '.proto' for path in changed):
+            try:
+                plan = compile_protobufs(service_directory, worker_count('auto'), echo=logger.info)
+            except click.ClickException as e:
+                logger.error(f'Build failed, still serving the previous version: {e.message}')
+                continue
+            timer.mark('build')
+            if plan.compile or plan.removed:
+                request_restart(restarting)
+                return
+        if any(is_generated(path) for path in changed):
+            request_restart(restarting)
+            return
+
+        # Dropping the affected modules and importing the service again runs them in the order they import each other.
+        names = affected_modules(changed, module.split('.')[0], always=[module])
+        previous_modules = {name: sys.modules.pop(name) for name in names}
+        reloaded = None
+        try:
+            load_grpc_service.cache_clear()
+            reloaded = load_service(module, timer)
+            configure(reloaded, module)
+            handler.handler = reloaded.create_service_handler()
+            timer.mark('handlers')
+        except Exception:
+            logger.exception('Reload failed, still serving the previous version')
+            if reloaded is not None:
+                reloaded.stop_process_pools()
+            for name in previous_modules:
+                sys.modules.pop(name, None)
+            sys.modules.update(previous_modules)
+            continue
+        # The previous version's worker processes would otherwise be left running, with the code it had.
+        app.stop_process_pools()
+        app = apps[0] = reloaded
+        logger.info(timer.report('Reloaded'))
 
-    handler = app.create_service_handler()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=threads))
-    server.add_generic_rpc_handlers((handler,))
+
+def request_restart(restarting: threading.Event):
+    # Generated modules cannot be imported again in the same process, their descriptors are already registered.
+    logger.info('Protobufs changed, restarting')
+    restarting.set()
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def restart():
+    arguments = getattr(sys, 'orig_argv', None) or [sys.executable, *sys.argv]
+    os.execv(sys.executable, [sys.executable, *arguments[1:]])
+
+
+def create_executor(threads: int, admission: AdmissionController = None) -> ServerExecutor:
+    # Calls wait for a thread in the pool, where only an executor from the admission controller can count them.
+    return admission.executor(threads) if admission is not None else ServerExecutor(max_workers=threads)
+
+
+def serve(handlers, bind, shutdown_grace, threads, options=None, timer: StartupTimer = None,
+          admission: AdmissionController = None):
+    server = grpc.server(create_executor(threads, admission), options=options)
+    server.add_generic_rpc_handlers(handlers)
     server.add_insecure_port(bind)
     server.start()
     logger.info(f'Started Petal. Listening on {bind}')
+    if timer is not None:
+        timer.mark('server')
+        logger.info(timer.report())
     try:
         while True:
             time.sleep(60 * 60 * 24)
     except KeyboardInterrupt:
         logger.info(f'Stopping. Closing all connections after {shutdown_grace} seconds.')
-        server.stop(grace=10)
+        # stop() returns straight away, wait for calls in flight to finish before the process exits.
+        server.stop(grace=shutdown_grace).wait()
         logger.info('Successfully stopped.')
 
 
+def serve_asyncio(handlers, bind, shutdown_grace, threads, options=None, timer: StartupTimer = None,
+                  admission: AdmissionController = None):
+    async def start():
+        server.add_generic_rpc_handlers(handlers)
+        server.add_insecure_port(bind)
+        await server.start()
+        logger.info(f'Started Petal with asyncio. Listening on {bind}')
+        if timer is not None:
+            timer.mark('server')
+            logger.info(timer.report())
+        await server.wait_for_termination()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = grpc.aio.server(migration_thread_pool=create_executor(threads, admission), options=options)
+    try:
+        loop.run_until_complete(start())
+    except KeyboardInterrupt:
+        logger.info(f'Stopping. Closing all connections after {shutdown_grace} seconds.')
+        loop.run_until_complete(server.stop(grace=shutdown_grace))
+        logger.info('Successfully stopped.')
+    finally:
+        loop.close()
+
+
+@cli.command()
+@click.argument('module')
+@click.option('--fixtures', type=click.Path(exists=True, dir_okay=False),
+              help='JSON file mapping method names to a list of requests to send.')
+@click.option('--method', 'methods', multiple=True, help='Only benchmark these methods. Defaults to all methods.')
+@click.option('--concurrency', default=10, type=int)
+@click.option('--duration', default=5.0, type=float, help='Seconds to benchmark each method for.')
+@click.option('--threads', default=10, type=int)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare the results against a JSON file previously written with --output.')
+def bench(module, fixtures, methods, concurrency, duration, threads, output, baseline):
+    app = load_service(module)
+    service = load_grpc_service(app.package, app.service_name)
+    payloads = load_payloads(Path(fixtures) if fixtures else None, service)
+    methods = methods or [method.name for method in service.methods]
+    unknown_methods = set(methods) - {method.name for method in service.methods}
+    if unknown_methods:
+        raise click.BadParameter(f'Unknown methods: {", ".join(sorted(unknown_methods))}', param_hint='--method')
+
+    click.echo(f'Benchmarking {len(methods)} methods with a concurrency of {concurrency} for {duration} seconds each')
+    results = run_benchmark(app.create_service_handler(), service, payloads, methods,
+                            concurrency, duration, threads, use_asyncio=app.is_async)
+    results_dict = {result.name: result.to_dict() for result in results}
+    changes = compare(results_dict, json.loads(Path(baseline).read_text())['methods']) if baseline else {}
+    print_results(results, changes)
+
+    if output:
+        Path(output).write_text(json.dumps({
+            'module': module,
+            'concurrency': concurrency,
+            'duration': duration,
+            'threads': threads,
+            'methods': results_dict,
+        }, indent=2) + '\n')
+        click.echo(f'Wrote results to {output}')
+
+
+def print_results(results: List[MethodResult], changes: Dict[str, Dict[str, float]]):
+    for result in results:
+        click.secho(result.name, bold=True)
+        click.echo(f'  {result.requests} requests, {result.errors} errors')
+        for key, label in (('rps', 'RPS'), ('p50_ms', 'p50'), ('p99_ms', 'p99'), ('p999_ms', 'p99.9')):
+            value = getattr(result, key)
+            line = f'  {label:<6} {value:10.2f}' + ('' if key == 'rps' else ' ms')
+            if key in changes.get(result.name, {}):
+                change = changes[result.name][key]
+                worse = change < 0 if key == 'rps' else change > 0
+                line += click.style(f'  ({change:+.1f}%)', fg='red' if worse else 'green')
+            click.echo(line)
+
+
+@cli.command()
+@click.argument('capture_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--target', default='localhost:50051', help='Address of the server to send the calls to.')
+@click.option('--speed', default=1.0, type=float,
+              help='Send calls at the times they were captured, this many times faster.')
+@click.option('--max-rate', is_flag=True, default=False,
+              help='Send calls as fast as --concurrency allows, rather than at the times they were captured.')
+@click.option('--concurrency', default=64, type=int, help='Most calls in flight at once.')
+@click.option('--method', 'methods', multiple=True, help='Only replay calls to these methods. Defaults to all methods.')
+@click.option('--timeout', default=None, type=float, help='Deadline in seconds for each call.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare the results against a JSON file previously written with --output.')
+def replay(capture_file, target, speed, max_rate, concurrency, methods, timeout, output, baseline):
+    if speed <= 0:
+        raise click.BadParameter('must be greater than 0', param_hint='--speed')
+    calls = read_capture(capture_file)
+    if methods:
+        calls = (call for call in calls if call.method.rsplit('/', 1)[-1] in methods or call.method in methods)
+
+    pace = 'as fast as possible' if max_rate else f'at {speed:g}x the captured rate'
+    click.echo(f'Replaying {capture_file} to {target} {pace}, with up to {concurrency} calls at once')
+    try:
+        results = replay_calls(calls, target, None if max_rate else speed, concurrency, timeout)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='CAPTURE_FILE')
+    results_dict = {result.name: result.to_dict() for result in results}
+    changes = compare(results_dict, json.loads(Path(baseline).read_text())['methods']) if baseline else {}
+    print_results(results, changes)
+
+    if output:
+        Path(output).write_text(json.dumps({
+            'capture': capture_file,
+            'target': target,
+            'speed': None if max_rate else speed,
+            'concurrency': concurrency,
+            'methods': results_dict,
+        }, indent=2) + '\n')
+        click.echo(f'Wrote results to {output}')
+
+
 @cli.command()
 @click.argument('service_directory', type=click.Path(exists=True, dir_okay=True, file_okay=False))
-def build(service_directory):
-    service_directory = Path(service_directory)
+@click.option('--jobs', default='auto', help='Number of protoc processes to run at once, or "auto" for one per core.')
+@click.option('--force', is_flag=True, default=False, help='Compile every file, even if it has not changed.')
+def build(service_directory, jobs, force):
+    try:
+        jobs = worker_count(jobs)
+    except ValueError:
+        raise click.BadParameter(f'{jobs} is not a number or "auto"', param_hint='--jobs')
+    if jobs < 1:
+        raise click.BadParameter('at least one protoc process is needed', param_hint='--jobs')
+
+    start = time.perf_counter()
+    plan = compile_protobufs(Path(service_directory), jobs, force)
+    click.echo(f'Compiled {len(plan.compile)} of {len(plan.keys)} files in {time.perf_counter() - start:.2f}s')
+
+
+def compile_protobufs(service_directory: Path, jobs: int, force: bool = False, echo=click.echo) -> BuildPlan:
     proto_directory = service_directory / 'protobuf'
     if not proto_directory.exists():
         raise click.UsageError(f'{proto_directory} does not exist.')
 
-    click.echo('Clearing output directory...')
-    proto_files = set(proto_directory.glob('*.proto')) | {proto_directory / '__init__.py'}
-    for path in proto_directory.iterdir():
-        if path.is_file() and path not in proto_files:
-            path.unlink()
-
     includes = []
     for entry_point in pkg_resources.iter_entry_points('petal_include_protobuf'):
         entry_point = Path(entry_point.load().__file__)
@@ -76,25 +528,27 @@ def build(service_directory):
             logger.warning(f'Registered include path {entry_point} does not exist')
             continue
 
-        includes.append(f'-I={entry_point.parent}')
-
-    proto_files = [str(f.relative_to(service_directory.parent)) for f in proto_directory.glob('*.proto')]
-
-    args = [
-        'python3',
-        '-m',
-        'grpc_tools.protoc',
-        f'--proto_path={service_directory.parent}/',
-        f'--grpc_python_out={service_directory.parent}/',
-        f'--python_out={service_directory.parent}/',
-        f'--extract-streaming_out={service_directory.parent}/',
-        f'--mypy_out={service_directory.parent}/',
-        *includes,
-        *proto_files
-    ]
-    click.echo('Compiling protobufs with ', nl=False)
-    click.secho(f'{" ".join(args)}', fg='green')
-    subprocess.check_call(args)
+        includes.append(entry_point.parent)
+
+    def protoc_arguments(manifest_name):
+        return [
+            'python3',
+            '-m',
+            'grpc_tools.protoc',
+            f'--proto_path={service_directory.parent}/',
+            f'--grpc_python_out={service_directory.parent}/',
+            f'--python_out={service_directory.parent}/',
+            f'--extract-streaming_out={manifest_name}:{service_directory.parent}/',
+            f'--mypy_out={service_directory.parent}/',
+            *(f'-I={include}' for include in includes),
+        ]
+
+    echo(f'Compiling protobufs with {click.style(" ".join(protoc_arguments(MANIFEST_NAME)), fg="green")}')
+    try:
+        return build_protobufs(service_directory.parent, proto_directory, includes, protoc_arguments, jobs, force,
+                               echo=echo)
+    except subprocess.CalledProcessError as e:
+        raise click.ClickException(f'{e.cmd} failed') from e
 
 
 def main():
@@ -0,0 +1,322 @@
+import itertools
+import queue
+import random
+import re
+import threading
+import time
+from typing import List, Union, Iterable, Optional, Dict, Tuple, Any, NamedTuple, Sequence
+
+import grpc
+
+from .grpc_services import GRPCService, GRPCMethod
+
+BALANCING = ('round_robin', 'least_loaded')
+RETRYABLE = (grpc.StatusCode.UNAVAILABLE,)
+
+
+class AttemptsCancelled(grpc.RpcError):
+    """
+    Raised when every attempt of a call was cancelled before any of them finished, like when the client is closed.
+    """
+
+    def code(self) -> grpc.StatusCode:
+        return grpc.StatusCode.CANCELLED
+
+    def details(self) -> str:
+        return 'Every attempt of the call was cancelled'
+
+
+def snake_case_name(name: str) -> str:
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+class RetryBudget:
+    """
+    Limits retries and hedged attempts to a fraction of the calls made, so a struggling server isn't sent even more
+    calls. Every call adds `ratio` of a token, and `min_per_second` tokens are added each second so a client making
+    few calls can still retry. Each extra attempt takes a whole token.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 10, max_tokens: float = 100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = float(min_per_second)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.min_per_second, self.max_tokens)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class PooledChannel:
+    __slots__ = ('endpoint', 'channel', 'in_flight', 'lock')
+
+    def __init__(self, endpoint: str, channel: grpc.Channel):
+        self.endpoint = endpoint
+        self.channel = channel
+        # Changed by the calling threads and by grpc's as calls finish.
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, *args):
+        with self.lock:
+            self.in_flight -= 1
+
+
+class ChannelPool:
+    """
+    Several channels to one or more endpoints. Each channel has its own connection, so calls are not all limited
+    by the number of concurrent streams the server allows on one HTTP/2 connection.
+    """
+
+    def __init__(self, endpoints: Sequence[str], channels_per_endpoint: int = 1, balancing: str = 'round_robin',
+                 options: Sequence[Tuple[str, Any]] = (), credentials: grpc.ChannelCredentials = None):
+        if balancing not in BALANCING:
+            raise ValueError(f'Unknown balancing {balancing}, expected one of {", ".join(BALANCING)}')
+        # Channels share connections to the same target unless each has its own subchannel pool.
+        options = [('grpc.use_local_subchannel_pool', 1), *options]
+        self.channels = [
+            PooledChannel(endpoint, grpc.secure_channel(endpoint, credentials, options) if credentials
+                          else grpc.insecure_channel(endpoint, options))
+            for _ in range(channels_per_endpoint) for endpoint in endpoints
+        ]
+        self.least_loaded = balancing == 'least_loaded'
+        self.counter = itertools.count(random.randrange(len(self.channels)))
+
+    def pick(self, exclude: Iterable[int] = ()) -> int:
+        count = len(self.channels)
+        start = next(self.counter) % count
+        if self.least_loaded:
+            # Starting from the next channel along spreads calls between channels that are equally loaded.
+            candidates = [(start + offset) % count for offset in range(count)]
+            candidates = [index for index in candidates if index not in exclude] or candidates
+            return min(candidates, key=lambda index: self.channels[index].in_flight)
+        for offset in range(count):
+            index = (start + offset) % count
+            if index not in exclude:
+                return index
+        return start
+
+    def close(self):
+        for pooled in self.channels:
+            pooled.channel.close()
+
+
+class ClientStats(NamedTuple):
+    calls: int
+    retries: int
+    hedges: int
+    budget_exhausted: int
+
+
+class ClientMethod:
+    """
+    Calls one method on whichever channel the pool picks. Unary calls return the response, streamed responses are
+    returned as an iterator, and streaming methods take an iterator of requests, like the generated stubs.
+    """
+
+    def __init__(self, client: 'Client', method: GRPCMethod, path: str, idempotent: bool):
+        self.client = client
+        self.name = method.name
+        self.stream_input = method.input_stream
+        self.stream_output = method.output_stream
+        shape = f'{"stream" if method.input_stream else "unary"}_{"stream" if method.output_stream else "unary"}'
+        self.callables = [
+            getattr(pooled.channel, shape)(path, request_serializer=method.input_type.SerializeToString,
+                                           response_deserializer=method.output_type.FromString)
+            for pooled in client.pool.channels
+        ]
+        # Only unary calls can be sent again, a stream of requests can only be read once.
+        self.resilient = idempotent and not (method.input_stream or method.output_stream) and (
+            client.hedge_after is not None or client.max_attempts > 1)
+
+    def __call__(self, request, timeout: float = None, metadata: Sequence[Tuple[str, Any]] = None):
+        client = self.client
+        with client.lock:
+            client.calls += 1
+        if self.resilient:
+            return self.call_resilient(request, timeout, metadata)
+
+        index = client.pool.pick()
+        pooled = client.pool.channels[index]
+        pooled.start()
+        if self.stream_output:
+            try:
+                call = self.callables[index](request, timeout=timeout, metadata=metadata)
+            except Exception:
+                pooled.finish()
+                raise
+            call.add_done_callback(pooled.finish)
+            return call
+        try:
+            return self.callables[index](request, timeout=timeout, metadata=metadata)
+        finally:
+            pooled.finish()
+
+    def call_resilient(self, request, timeout: Optional[float], metadata):
+        """
+        Send the call, sending it again to another channel when an attempt fails with a retryable status, or when
+        `hedge_after` seconds pass without a response. The first response wins and the other attempts are cancelled.
+        Extra attempts are limited by `max_attempts` and the retry budget, and retries wait for a jittered backoff
+        first, unless the deadline would pass before they could be sent.
+        """
+        client = self.client
+        pool = client.pool
+        budget = client.retry_budget
+        budget.deposit()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        finished = queue.SimpleQueue()
+        pending: List[grpc.Future] = []
+        tried: List[int] = []
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+        def attempt():
+            index = pool.pick(tried)
+            tried.append(index)
+            pooled = pool.channels[index]
+            pooled.start()
+            future = self.callables[index].future(request, timeout=remaining(), metadata=metadata)
+            pending.append(future)
+
+            def done(completed):
+                pooled.finish()
+                finished.put(completed)
+            future.add_done_callback(done)
+
+        def extra_attempt(delay: float = 0) -> bool:
+            if len(tried) >= client.max_attempts:
+                return False
+            if deadline is not None and remaining() <= delay:
+                return False
+            if not budget.withdraw():
+                with client.lock:
+                    client.budget_exhausted += 1
+                return False
+            if delay:
+                time.sleep(delay)
+            attempt()
+            return True
+
+        attempt()
+        can_hedge = client.hedge_after is not None
+        error = None
+        while pending:
+            # Every attempt is sent with the time left before the deadline, so they all finish by then.
+            try:
+                completed = finished.get(timeout=client.hedge_after if can_hedge else None)
+            except queue.Empty:
+                can_hedge = extra_attempt()
+                if can_hedge:
+                    with client.lock:
+                        client.hedges += 1
+                continue
+            pending.remove(completed)
+            if completed.cancelled():
+                continue
+            try:
+                response = completed.result()
+            except grpc.RpcError as e:
+                error = e
+                if e.code() in client.retry_codes and not pending and extra_attempt(client.backoff_delay(len(tried))):
+                    with client.lock:
+                        client.retries += 1
+                continue
+            for other in pending:
+                other.cancel()
+            return response
+
+        raise error or AttemptsCancelled()
+
+
+class Client:
+    """
+    A client for a petal service, or any gRPC service described by the protobufs in `package`, with a method for
+    each of its gRPC methods, by their gRPC or Python names:
+
+        client = Client('example', ['10.0.0.1:50051', '10.0.0.2:50051'], channels_per_endpoint=2)
+        reply = client.SayHello(HelloRequest(name='petal'), timeout=1)
+
+    Calls are spread over a pool of channels, `round_robin` or to the channel with the fewest calls in flight with
+    `least_loaded`. Methods listed in `idempotent`, or every method if it is True, are safe to send more than once:
+    unary calls to them are retried on another channel when they fail with one of `retry_codes`, up to
+    `max_attempts` attempts, and with `hedge_after` another attempt is sent if there is no response after that many
+    seconds. Extra attempts are limited by `retry_budget`.
+
+    Before the nth retry the client waits a random time of up to `backoff` * 2 ** (n - 1) seconds, and at most
+    `max_backoff`, so clients that failed together don't all retry at the same moment.
+    """
+
+    def __init__(self, package: str, endpoints: Union[str, Sequence[str]], service_name: str = None,
+                 channels_per_endpoint: int = 1, balancing: str = 'round_robin',
+                 idempotent: Union[bool, Iterable[str]] = False, max_attempts: int = 3, hedge_after: float = None,
+                 retry_budget: RetryBudget = None, retry_codes: Iterable[grpc.StatusCode] = RETRYABLE,
+                 options: Sequence[Tuple[str, Any]] = (), credentials: grpc.ChannelCredentials = None,
+                 backoff: float = 0.05, max_backoff: float = 1):
+        from . import load_grpc_service
+
+        self.methods: Dict[str, ClientMethod] = {}
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        self.service: GRPCService = load_grpc_service(package, service_name)
+        self.pool = ChannelPool(endpoints, channels_per_endpoint, balancing, options, credentials)
+        self.max_attempts = max_attempts
+        self.hedge_after = hedge_after
+        self.retry_budget = retry_budget or RetryBudget()
+        self.retry_codes = set(retry_codes)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Counted from every thread making calls.
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.budget_exhausted = 0
+
+        if idempotent is not True and idempotent is not False:
+            idempotent = set(idempotent)
+        for method in self.service.methods:
+            is_idempotent = idempotent is True or (idempotent is not False and method.name in idempotent)
+            client_method = ClientMethod(self, method, f'/{self.service.full_name}/{method.name}', is_idempotent)
+            self.methods[method.name] = client_method
+            self.methods[snake_case_name(method.name)] = client_method
+
+    def backoff_delay(self, attempts: int) -> float:
+        return random.uniform(0, min(self.backoff * 2 ** (attempts - 1), self.max_backoff))
+
+    def __getattr__(self, item) -> ClientMethod:
+        try:
+            return self.methods[item]
+        except KeyError:
+            raise AttributeError(item) from None
+
+    def stats(self) -> ClientStats:
+        with self.lock:
+            return ClientStats(calls=self.calls, retries=self.retries, hedges=self.hedges,
+                               budget_exhausted=self.budget_exhausted)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
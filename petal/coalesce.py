@@ -0,0 +1,156 @@
+import asyncio
+import functools
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import grpc
+
+from .dispatch import EXPIRED, queued
+from .exceptions import GRPCError
+
+MAX_WAIT = 60.0
+
+
+class RecordingContext:
+    """
+    Stands in for the context of the call that runs a coalesced method, recording the status it sets so it can
+    be copied to every call that shares the result. Everything else is passed through to the real context.
+    """
+
+    def __init__(self, context_object):
+        self.context_object = context_object
+        self.code: Optional[grpc.StatusCode] = None
+        self.details: Optional[str] = None
+
+    def __getattr__(self, item):
+        return getattr(self.context_object, item)
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+    def abort(self, code, details=''):
+        self.code, self.details = code, details
+        raise GRPCError(details, code=code)
+
+    def apply(self, context_object):
+        if self.code is not None:
+            context_object.set_code(self.code)
+        if self.details:
+            context_object.set_details(self.details)
+
+
+class AsyncRecordingContext(RecordingContext):
+    async def abort(self, code, details=''):
+        self.code, self.details = code, details
+        raise grpc.aio.AbortError()
+
+
+class Flight:
+    def __init__(self, context_object):
+        self.context = RecordingContext(context_object)
+        self.condition = threading.Condition()
+        self.done = False
+        self.response: Optional[bytes] = None
+
+
+def coalesce_dispatcher(dispatcher: Callable) -> Callable:
+    """
+    Wrap a serialized dispatcher so concurrent calls with identical requests share a single call to it. Calls whose
+    deadline passed while they waited for a thread neither start nor join one, and calls that join a call already in
+    flight stop waiting when their own deadline passes or they are cancelled.
+    """
+    flights: Dict[bytes, Flight] = {}
+    lock = threading.Lock()
+
+    def wait(flight: Flight, context_object) -> bool:
+        # Neither is there on the context grpc.aio gives synchronous methods, as in dispatch.stream_dispatcher.
+        add_callback = getattr(context_object, 'add_callback', None)
+        is_active = getattr(context_object, 'is_active', lambda: True)
+        with flight.condition:
+            if add_callback is not None:
+                add_callback(functools.partial(notify, flight))
+            while not flight.done:
+                if not is_active():
+                    return False
+                remaining = context_object.time_remaining()
+                if remaining is not None and remaining <= 0:
+                    context_object.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+                    context_object.set_details('Deadline exceeded waiting for a coalesced call')
+                    return False
+                # Calls without a deadline report a huge time remaining, too large to wait on in one go.
+                flight.condition.wait(min(remaining, MAX_WAIT) if remaining is not None else MAX_WAIT)
+        return True
+
+    def coalesced(request_bytes, context_object):
+        # The dispatcher doesn't check deadlines, since its call is shared, so each caller checks its own.
+        if queued.late and expired(context_object):
+            context_object.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+            context_object.set_details(EXPIRED)
+            return None
+
+        with lock:
+            flight = flights.get(request_bytes)
+            leader = flight is None
+            if leader:
+                flight = flights[request_bytes] = Flight(context_object)
+
+        if leader:
+            try:
+                flight.response = dispatcher(request_bytes, flight.context)
+            finally:
+                with lock:
+                    del flights[request_bytes]
+                notify(flight, done=True)
+        elif not wait(flight, context_object):
+            return None
+
+        flight.context.apply(context_object)
+        return flight.response
+
+    return functools.wraps(dispatcher)(coalesced)
+
+
+def expired(context_object) -> bool:
+    remaining = context_object.time_remaining()
+    return remaining is not None and remaining <= 0
+
+
+def notify(flight: Flight, done: bool = False):
+    with flight.condition:
+        flight.done = flight.done or done
+        flight.condition.notify_all()
+
+
+def async_coalesce_dispatcher(dispatcher: Callable) -> Callable:
+    flights: Dict[bytes, Tuple[asyncio.Task, AsyncRecordingContext]] = {}
+
+    async def run(request_bytes, recording_context):
+        try:
+            return await dispatcher(request_bytes, recording_context)
+        finally:
+            del flights[request_bytes]
+
+    async def coalesced(request_bytes, context_object):
+        if expired(context_object):
+            await context_object.abort(grpc.StatusCode.DEADLINE_EXCEEDED, EXPIRED)
+        if request_bytes not in flights:
+            recording_context = AsyncRecordingContext(context_object)
+            task = asyncio.ensure_future(run(request_bytes, recording_context))
+            flights[request_bytes] = (task, recording_context)
+        task, recording_context = flights[request_bytes]
+
+        # Shielded so cancelling one caller, or its deadline passing, does not cancel the call for everyone else.
+        try:
+            response = await asyncio.wait_for(asyncio.shield(task), context_object.time_remaining())
+        except asyncio.TimeoutError:
+            await context_object.abort(grpc.StatusCode.DEADLINE_EXCEEDED)
+        except grpc.aio.AbortError:
+            await context_object.abort(recording_context.code, recording_context.details or '')
+
+        recording_context.apply(context_object)
+        return response
+
+    return functools.wraps(dispatcher)(coalesced)
@@ -0,0 +1,303 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from concurrent import futures
+from typing import Callable, Optional
+
+import grpc
+
+from . import exceptions
+
+context = contextvars.ContextVar('petal.context')
+
+EXPIRED = 'Deadline exceeded before the call started'
+
+# grpc reports calls without a deadline as having a huge amount of time remaining.
+NO_DEADLINE = 365 * 24 * 60 * 60
+
+# Calls that get a thread sooner than this many seconds after they arrive don't have their deadline checked.
+LATE_AFTER = 0.001
+
+
+class Queued(threading.local):
+    # Whether the call running on this thread waited long enough for it that its deadline may have passed meanwhile.
+    late = False
+
+
+queued = Queued()
+
+
+class ServerExecutor(futures.ThreadPoolExecutor):
+    """
+    The thread pool of a server, which notes the calls that waited in its queue so that only those have their deadline
+    checked before running.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        arrived = time.perf_counter()
+
+        def run():
+            queued.late = time.perf_counter() - arrived > LATE_AFTER
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                queued.late = False
+
+        return super().submit(run)
+
+
+def time_remaining() -> Optional[float]:
+    """
+    The number of seconds left before the deadline of the current call, or None if it has no deadline.
+    """
+    context_object = context.get(None)
+    if context_object is None:
+        return None
+    remaining = context_object.time_remaining()
+    return None if remaining is None or remaining > NO_DEADLINE else remaining
+
+
+def cancelled() -> bool:
+    """
+    Whether the current call has been cancelled by the client or gone past its deadline, so a long running method
+    can give up on work nobody will read.
+    """
+    context_object = context.get(None)
+    if context_object is None:
+        return False
+    is_active = getattr(context_object, 'is_active', None)
+    if is_active is not None:
+        return not is_active()
+    return context_object.cancelled() or context_object.time_remaining() == 0
+
+
+def check_deadline(context_object: grpc.ServicerContext):
+    remaining = context_object.time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise exceptions.DeadlineExceeded(EXPIRED)
+
+
+def set_error_status(context_object: grpc.ServicerContext, error: Exception) -> bool:
+    if isinstance(error, exceptions.GRPCError):
+        context_object.set_code(error.code)
+        if error.details:
+            context_object.set_details(error.details)
+        return True
+    if isinstance(error, NotImplementedError):
+        context_object.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        return True
+    return False
+
+
+async def abort_with_error(context_object: 'grpc.aio.ServicerContext', error: Exception, logger, name: str):
+    if isinstance(error, exceptions.GRPCError):
+        await context_object.abort(error.code, error.details)
+    elif isinstance(error, NotImplementedError):
+        await context_object.abort(grpc.StatusCode.UNIMPLEMENTED)
+    else:
+        # Returning nothing would leave grpc.aio failing to serialize None instead.
+        log_error(logger, context_object, name)
+        await context_object.abort(grpc.StatusCode.UNKNOWN, f'Exception calling application: {error}')
+
+
+def log_error(logger, context_object: grpc.ServicerContext, name: str):
+    # The peer is only looked up once something has gone wrong, it is not free.
+    logger.bind(peer=context_object.peer()).exception(f'An error has been caught in {name}')
+
+
+def create_dispatcher(func: Callable, stream_output: bool, logger, deadline: bool = True) -> Callable:
+    """
+    Build the function gRPC calls for a single method. The shape of `func` is inspected once here
+    so that each call only does the work that shape needs.
+
+    Unless `deadline` is False, calls whose deadline passed while they were waiting for a thread of a `ServerExecutor`
+    fail with `DeadlineExceeded` without running the method.
+    """
+    if inspect.isasyncgenfunction(func):
+        dispatcher = async_stream_dispatcher(func, logger, deadline)
+    elif inspect.iscoroutinefunction(func):
+        dispatcher = async_dispatcher(func, logger, deadline)
+    elif stream_output:
+        dispatcher = stream_dispatcher(func, logger, deadline)
+    else:
+        dispatcher = unary_dispatcher(func, logger, deadline)
+    return functools.wraps(func)(dispatcher)
+
+
+def unary_dispatcher(func: Callable, logger, deadline: bool = True) -> Callable:
+    name = func.__qualname__
+    # Looked up once here rather than on every call, this is the hottest path.
+    set_context, reset_context, thread = context.set, context.reset, queued
+
+    def dispatch(request_object, context_object):
+        token = set_context(context_object)
+        try:
+            # Reading the deadline through grpc's context costs more than the rest of the dispatch, so it is only
+            # done for calls that had to wait.
+            if deadline and thread.late:
+                check_deadline(context_object)
+            return func(request_object)
+        except Exception as e:
+            if not set_error_status(context_object, e):
+                log_error(logger, context_object, name)
+        finally:
+            reset_context(token)
+
+    return dispatch
+
+
+def stream_dispatcher(func: Callable, logger, deadline: bool = True) -> Callable:
+    name = func.__qualname__
+
+    # Responses may be pulled from different threads, so each RPC gets its own context to run them in.
+    def dispatch(request_object, context_object):
+        ctx = contextvars.copy_context()
+        ctx.run(context.set, context_object)
+        # Synchronous methods served by grpc.aio are given its context, which cannot tell us about cancellation.
+        is_active = getattr(context_object, 'is_active', None)
+        try:
+            if deadline and queued.late:
+                check_deadline(context_object)
+            responses = iter(ctx.run(func, request_object))
+            while True:
+                if is_active is not None and not is_active():
+                    # The client has gone, stop the method at its next yield rather than computing the rest.
+                    close = getattr(responses, 'close', None)
+                    if close is not None:
+                        ctx.run(close)
+                    return
+                try:
+                    response = ctx.run(next, responses)
+                except StopIteration:
+                    return
+                yield response
+        except Exception as e:
+            if not set_error_status(context_object, e):
+                log_error(logger, context_object, name)
+
+    return dispatch
+
+
+def async_dispatcher(func: Callable, logger, deadline: bool = True) -> Callable:
+    name = func.__qualname__
+
+    # Every RPC on a grpc.aio server runs in its own task, which already has a copy of the context.
+    async def dispatch(request_object, context_object):
+        context.set(context_object)
+        try:
+            if deadline:
+                check_deadline(context_object)
+            return await func(request_object)
+        except grpc.aio.AbortError:
+            raise
+        except Exception as e:
+            await abort_with_error(context_object, e, logger, name)
+
+    return dispatch
+
+
+def async_stream_dispatcher(func: Callable, logger, deadline: bool = True) -> Callable:
+    name = func.__qualname__
+
+    async def dispatch(request_object, context_object):
+        context.set(context_object)
+        try:
+            if deadline:
+                check_deadline(context_object)
+            async for response in func(request_object):
+                yield response
+        except grpc.aio.AbortError:
+            raise
+        except Exception as e:
+            await abort_with_error(context_object, e, logger, name)
+
+    return dispatch
+
+
+def wrap_calls(func: Callable, stream_output: bool, enter: Callable, leave: Callable, enter_async: Callable = None,
+               requests: Callable = None, responses: Callable = None) -> Callable:
+    """
+    Wrap a method or a dispatcher, whatever its shape, to call `enter` with its arguments before each call and
+    `leave(state, result)` once the call is over, `state` being whatever `enter` returned. `result` is the response
+    of a unary call, True once a stream has sent its last response, or None if the call failed.
+
+    Async methods await `enter_async` instead, if it is given. `requests(state, requests)` and
+    `responses(state, responses)` can stand in for the streams of a call, and are given async iterators by async
+    methods.
+    """
+    if inspect.isasyncgenfunction(func):
+        async def wrapped(request, *args):
+            state = enter(request, *args) if enter_async is None else await enter_async(request, *args)
+            if requests is not None:
+                request = requests(state, request)
+            result = None
+            try:
+                stream = func(request, *args)
+                async for response in (stream if responses is None else responses(state, stream)):
+                    yield response
+                result = True
+            finally:
+                leave(state, result)
+    elif inspect.iscoroutinefunction(func):
+        async def wrapped(request, *args):
+            state = enter(request, *args) if enter_async is None else await enter_async(request, *args)
+            if requests is not None:
+                request = requests(state, request)
+            result = None
+            try:
+                result = await func(request, *args)
+                return result
+            finally:
+                leave(state, result)
+    elif stream_output:
+        def wrapped(request, *args):
+            state = enter(request, *args)
+            if requests is not None:
+                request = requests(state, request)
+            result = None
+            try:
+                stream = func(request, *args)
+                yield from (stream if responses is None else responses(state, stream))
+                result = True
+            finally:
+                leave(state, result)
+    else:
+        def wrapped(request, *args):
+            state = enter(request, *args)
+            if requests is not None:
+                request = requests(state, request)
+            result = None
+            try:
+                result = func(request, *args)
+                return result
+            finally:
+                leave(state, result)
+
+    return functools.wraps(func)(wrapped)
+
+
+def serialized_dispatcher(dispatcher: Callable, request_deserializer: Optional[Callable],
+                          response_serializer: Optional[Callable], is_async: bool) -> Callable:
+    """
+    Adapt a unary dispatcher to take serialized requests and return serialized responses, for the layers that
+    work with the raw bytes. A failed call still returns None.
+    """
+    deserialize = request_deserializer or identity
+    serialize = response_serializer or identity
+
+    if is_async:
+        async def dispatch(request_bytes, context_object):
+            response = await dispatcher(deserialize(request_bytes), context_object)
+            return None if response is None else serialize(response)
+    else:
+        def dispatch(request_bytes, context_object):
+            response = dispatcher(deserialize(request_bytes), context_object)
+            return None if response is None else serialize(response)
+
+    return functools.wraps(dispatcher)(dispatch)
+
+
+def identity(value):
+    return value
@@ -57,6 +57,16 @@ class IncorrectMethodArguments(InitializationException):
             f'Please update your service definitions to ensure the types are correct.'
 
 
+class UnsupportedMethodOption(InitializationException):
+    def __init__(self, method_name: str, option: str, reason: str):
+        self.method_name = method_name
+        self.option = option
+        self.reason = reason
+
+    def __str__(self):
+        return f'Method {self.method_name} cannot use {self.option}: {self.reason}'
+
+
 class GRPCError(Exception):
     code = None
     details = ""
@@ -1,10 +1,14 @@
+import json
 import pkgutil
 
 import importlib
-from typing import NamedTuple, List, Dict, Generator, Type
+from pathlib import Path
+from typing import NamedTuple, List, Dict, Generator, Type, Optional
 from types import ModuleType
 from google.protobuf import symbol_database
 
+from .protoc_gen_extract_streaming import MANIFEST_NAME, MANIFEST_VERSION
+
 pb_symbol_database = symbol_database.Default()
 
 
@@ -49,8 +53,51 @@ def load_all_grpc_services(package: str) -> Dict[str, GRPCService]:
     return services
 
 
+def protobuf_directory(package: str) -> Path:
+    """
+    Where the protobufs of `package` are, found through the imported package so packages outside the working
+    directory, like the services a client calls, can be loaded too.
+    """
+    try:
+        module = importlib.import_module(f'{package}.protobuf')
+    except ImportError:
+        return Path(f'{package}/protobuf')
+    # Not every protobuf directory has an __init__.py, and namespace packages have no __file__.
+    return Path(list(module.__path__)[0])
+
+
 def iter_modules(package: str) -> Generator[ModuleType, None, None]:
-    for module_info in pkgutil.iter_modules([f'{package}/protobuf']):
+    for module_info in pkgutil.iter_modules([str(protobuf_directory(package))]):
         if not module_info.name.endswith('_pb2'):
             continue
         yield importlib.import_module(f'{package}.protobuf.{module_info.name}')
+
+
+def read_manifest(package: str) -> Optional[Dict[str, dict]]:
+    """
+    The services described by the manifest `petal build` writes, keyed by name, or None if there isn't one.
+    """
+    path = protobuf_directory(package) / MANIFEST_NAME
+    if not path.exists():
+        return None
+    manifest = json.loads(path.read_text())
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest['services']
+
+
+def load_manifest_service(name: str, entry: dict) -> GRPCService:
+    # Only the modules defining this service and its messages are imported.
+    for module in {entry['module']} | {method[f'{kind}_module'] for method in entry['methods']
+                                       for kind in ('input', 'output')}:
+        importlib.import_module(module)
+
+    return GRPCService(name=name, full_name=entry['full_name'], methods=[
+        GRPCMethod(name=method['name'],
+                   full_name=f'{entry["full_name"]}.{method["name"]}',
+                   input_type=pb_symbol_database.GetSymbol(method['input_type']),
+                   output_type=pb_symbol_database.GetSymbol(method['output_type']),
+                   input_stream=method['input_stream'],
+                   output_stream=method['output_stream'])
+        for method in entry['methods']
+    ])
@@ -0,0 +1,49 @@
+from typing import Generic, TypeVar, Type, Tuple, Optional
+
+from google.protobuf.message import Message
+
+M = TypeVar('M', bound=Message)
+
+
+class Raw(Generic[M]):
+    """
+    Annotate a request or response as `Raw[HelloRequest]` to receive or return it as serialized bytes,
+    skipping deserialization or serialization entirely.
+    """
+
+
+class Lazy(Generic[M]):
+    """
+    A message that is only parsed the first time one of its fields is accessed. If it is never parsed, or returned
+    as a response, the original bytes are used as they are.
+    """
+    __slots__ = ('message_type', 'data', '_message')
+
+    def __init__(self, message_type: Type[M], data: bytes):
+        self.message_type = message_type
+        self.data = data
+        self._message: Optional[M] = None
+
+    @property
+    def message(self) -> M:
+        if self._message is None:
+            self._message = self.message_type.FromString(self.data)
+        return self._message
+
+    def __getattr__(self, item):
+        return getattr(self.message, item)
+
+    def SerializeToString(self) -> bytes:
+        if self._message is None:
+            return self.data
+        return self._message.SerializeToString()
+
+    def __repr__(self):
+        return f'Lazy[{self.message_type.__name__}]({len(self.data)} bytes)'
+
+
+def unwrap_encoding(annotation) -> Tuple[Type, Optional[type]]:
+    origin = getattr(annotation, '__origin__', None)
+    if origin in (Raw, Lazy):
+        return annotation.__args__[0], origin
+    return annotation, None
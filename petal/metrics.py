@@ -0,0 +1,282 @@
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Callable, Tuple, Iterable
+
+import grpc
+
+from .dispatch import wrap_calls
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Shard:
+    """
+    The metrics recorded by a single thread. Only that thread writes to it, so no locks are needed, and the
+    shards of every thread are summed when the metrics are collected.
+    """
+    __slots__ = ('started', 'in_flight', 'ok', 'codes', 'latency', 'latency_sum', 'request_sizes', 'request_bytes',
+                 'response_sizes', 'response_bytes')
+
+    def __init__(self):
+        # Calls only count themselves in when they start, what is in flight is worked out from the calls that have
+        # finished when the shards are collected, saving a write at the end of every call.
+        self.started = 0
+        self.in_flight = 0
+        # Successful calls are counted separately, hashing an enum member is surprisingly slow.
+        self.ok = 0
+        self.codes: Dict[grpc.StatusCode, int] = dict.fromkeys(grpc.StatusCode, 0)
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.request_sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.request_bytes = 0
+        self.response_sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.response_bytes = 0
+
+
+class MethodMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.local = threading.local()
+        self.shards: List[Shard] = []
+        self.lock = threading.Lock()
+
+    def shard(self) -> Shard:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def wrap_deserializer(self, deserializer: Optional[Callable]) -> Callable:
+        def deserialize(data: bytes):
+            shard = self.shard()
+            shard.request_sizes[bisect_left(SIZE_BUCKETS, len(data))] += 1
+            shard.request_bytes += len(data)
+            return deserializer(data) if deserializer else data
+        return deserialize
+
+    def wrap_serializer(self, serializer: Optional[Callable]) -> Callable:
+        def serialize(message) -> bytes:
+            data = serializer(message) if serializer else message
+            shard = self.shard()
+            shard.response_sizes[bisect_left(SIZE_BUCKETS, len(data))] += 1
+            shard.response_bytes += len(data)
+            return data
+        return serialize
+
+    def wrap(self, dispatcher: Callable, stream_output: bool) -> Callable:
+        """
+        Wrap the outermost dispatcher of a method, reading the status it set from the context once it finishes.
+        Unary calls are on the path of every call the budget covers, so their recording is written out in full.
+        """
+        local, get_shard, perf_counter = self.local, self.shard, time.perf_counter
+        # Most calls land in the first bucket, which is quicker to check for than to search for.
+        buckets, fastest = LATENCY_BUCKETS, LATENCY_BUCKETS[0]
+
+        if stream_output or inspect.iscoroutinefunction(dispatcher) or inspect.isasyncgenfunction(dispatcher):
+            def enter(request, context_object) -> tuple:
+                get_shard().started += 1
+                return perf_counter(), context_object
+
+            def leave(state: tuple, result):
+                start, context_object = state
+                elapsed = perf_counter() - start
+                code = status_code(context_object, result)
+                # Responses may have been pulled from another thread, so use its shard.
+                shard = get_shard()
+                if code is OK:
+                    shard.ok += 1
+                else:
+                    shard.codes[code] += 1
+                shard.latency[0 if elapsed <= fastest else bisect_left(buckets, elapsed)] += 1
+                shard.latency_sum += elapsed
+
+            return wrap_calls(dispatcher, stream_output, enter, leave)
+
+        # Servers give every call the same type of context, so how to read its code is only looked up again if
+        # a call brings a different one.
+        resolved = (None, no_code)
+
+        def measured(request, context_object):
+            nonlocal resolved
+            try:
+                shard = local.shard
+            except AttributeError:
+                shard = get_shard()
+            shard.started += 1
+            start = perf_counter()
+            response = None
+            try:
+                response = dispatcher(request, context_object)
+                return response
+            finally:
+                elapsed = perf_counter() - start
+                context_type, read_code = resolved
+                if type(context_object) is not context_type:
+                    context_type = type(context_object)
+                    read_code = code_reader(context_type)
+                    resolved = (context_type, read_code)
+                code = read_code(context_object)
+                if code is None and response is not None:
+                    shard.ok += 1
+                else:
+                    shard.codes[code or UNKNOWN] += 1
+                shard.latency[0 if elapsed <= fastest else bisect_left(buckets, elapsed)] += 1
+                shard.latency_sum += elapsed
+
+        return functools.wraps(dispatcher)(measured)
+
+    def collect(self) -> Shard:
+        total = Shard()
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            total.started += shard.started
+            total.codes[OK] += shard.ok
+            for code, count in shard.codes.items():
+                total.codes[code] += count
+            total.latency = [a + b for a, b in zip(total.latency, shard.latency)]
+            total.latency_sum += shard.latency_sum
+            total.request_sizes = [a + b for a, b in zip(total.request_sizes, shard.request_sizes)]
+            total.request_bytes += shard.request_bytes
+            total.response_sizes = [a + b for a, b in zip(total.response_sizes, shard.response_sizes)]
+            total.response_bytes += shard.response_bytes
+        # Shards are read while calls carry on, so a call may be seen finishing without being seen starting.
+        total.in_flight = max(total.started - sum(total.codes.values()), 0)
+        return total
+
+
+OK = grpc.StatusCode.OK
+UNKNOWN = grpc.StatusCode.UNKNOWN
+
+
+# How to read the status code set on each type of context, looked up once per type rather than on every call.
+CODE_READERS: Dict[type, Callable[[object], Optional[grpc.StatusCode]]] = {}
+
+
+def no_code(context_object) -> None:
+    return None
+
+
+def code_reader(context_type: type) -> Callable[[object], Optional[grpc.StatusCode]]:
+    # The context grpc.aio gives synchronous methods has no code(), so only failures to respond are seen there.
+    reader = CODE_READERS[context_type] = getattr(context_type, 'code', no_code)
+    return reader
+
+
+def status_code(context_object, result) -> grpc.StatusCode:
+    context_type = type(context_object)
+    code = (CODE_READERS.get(context_type) or code_reader(context_type))(context_object)
+    if code is not None:
+        return code
+    # Calls that return nothing without setting a status fail when their response is serialized.
+    if result is None:
+        return UNKNOWN
+    return OK
+
+
+class Metrics:
+    def __init__(self):
+        self.methods: Dict[str, MethodMetrics] = {}
+        self.collectors: List[Callable[[], Iterable[Tuple[str, str, Dict[str, str], float]]]] = []
+
+    def method(self, name: str) -> MethodMetrics:
+        if name not in self.methods:
+            self.methods[name] = MethodMetrics(name)
+        return self.methods[name]
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, Dict[str, str], float]]]):
+        """
+        Add a function returning extra (name, type, labels, value) samples to export.
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name, metric_type, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        def histogram(name, method, buckets, bounds, total):
+            cumulative = 0
+            for bound, count in zip(bounds, buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+            cumulative += buckets[-1]
+            lines.append(f'{name}_bucket{{method="{method}",le="+Inf"}} {cumulative}')
+            lines.append(f'{name}_sum{{method="{method}"}} {total}')
+            lines.append(f'{name}_count{{method="{method}"}} {cumulative}')
+
+        collected = {name: method.collect() for name, method in sorted(self.methods.items())}
+
+        metric('petal_requests_total', 'counter', 'Finished calls by method and status code.')
+        for name, shard in collected.items():
+            for code, count in sorted(shard.codes.items(), key=lambda item: item[0].name):
+                if count:
+                    lines.append(f'petal_requests_total{{method="{name}",code="{code.name}"}} {count}')
+
+        metric('petal_in_flight', 'gauge', 'Calls currently running.')
+        for name, shard in collected.items():
+            lines.append(f'petal_in_flight{{method="{name}"}} {shard.in_flight}')
+
+        metric('petal_request_duration_seconds', 'histogram', 'Time taken to handle each call.')
+        for name, shard in collected.items():
+            histogram('petal_request_duration_seconds', name, shard.latency, LATENCY_BUCKETS, shard.latency_sum)
+
+        metric('petal_request_size_bytes', 'histogram', 'Size of each serialized request message.')
+        for name, shard in collected.items():
+            histogram('petal_request_size_bytes', name, shard.request_sizes, SIZE_BUCKETS, shard.request_bytes)
+
+        metric('petal_response_size_bytes', 'histogram', 'Size of each serialized response message.')
+        for name, shard in collected.items():
+            histogram('petal_response_size_bytes', name, shard.response_sizes, SIZE_BUCKETS, shard.response_bytes)
+
+        seen = set()
+        samples = set()
+        for collector in self.collectors:
+            for name, metric_type, labels, value in collector():
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                # Services sharing an admission controller all report it.
+                if (name, label_text) in samples:
+                    continue
+                samples.add((name, label_text))
+                if name not in seen:
+                    lines.append(f'# TYPE {name} {metric_type}')
+                    seen.add(name)
+                lines.append(f'{name}{{{label_text}}} {value}' if labels else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """
+        Serve the metrics in the Prometheus text format on /metrics, from a background thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='petal-metrics', daemon=True).start()
+        return server
@@ -0,0 +1,117 @@
+import functools
+import importlib
+import multiprocessing
+import os
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple, Dict, Callable
+
+import grpc
+
+from . import exceptions
+
+# Functions looked up in each worker process, keyed on (module, method name).
+worker_functions: Dict[Tuple[str, str], Tuple[Callable, Optional[Callable], Optional[Callable]]] = {}
+
+
+def import_module(module: str):
+    importlib.import_module(module)
+
+
+def find_function(module: str, name: str) -> Tuple[Callable, Optional[Callable], Optional[Callable]]:
+    key = (module, name)
+    if key not in worker_functions:
+        from . import Service
+        module_object = importlib.import_module(module)
+        for value in vars(module_object).values():
+            if not isinstance(value, Service):
+                continue
+            for handler in value.rpc_methods:
+                if handler.name == name and handler.process_pool is not None:
+                    worker_functions[key] = (handler.python_function,
+                                             handler.request_deserializer,
+                                             handler.response_serializer)
+        if key not in worker_functions:
+            raise LookupError(f'Cannot find method {name} in {module}')
+    return worker_functions[key]
+
+
+def run_in_worker(module: str, name: str,
+                  request_bytes: bytes) -> Tuple[Optional[bytes], Optional[grpc.StatusCode], Optional[str]]:
+    """
+    Runs in a worker process. Errors that map to a status code are returned rather than raised, so they
+    don't need to be pickled. Anything else is raised and re-raised in the server process.
+    """
+    func, deserialize, serialize = find_function(module, name)
+    try:
+        response = func(deserialize(request_bytes) if deserialize else request_bytes)
+    except exceptions.GRPCError as e:
+        return None, e.code, e.details
+    except NotImplementedError:
+        return None, grpc.StatusCode.UNIMPLEMENTED, None
+    if response is None:
+        return None, None, None
+    return serialize(response) if serialize else response, None, None
+
+
+class ProcessPool:
+    """
+    A pool of worker processes that have each imported the module a method is defined in. Only serialized
+    requests and responses are sent between processes.
+
+    If a worker dies, the calls it was sharing the pool with fail with Unavailable and the pool is started again for
+    the next ones.
+    """
+
+    def __init__(self, module: str, name: str, workers: Optional[int]):
+        self.module = module
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.executor: Optional[futures.ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+
+    def start(self, broken: Optional[futures.ProcessPoolExecutor] = None):
+        # Given the executor a call found broken, only the first of the calls that did replaces it.
+        with self.lock:
+            if self.executor is not broken:
+                return
+            if broken is not None:
+                broken.shutdown(wait=False)
+            # Forking a process that is already running gRPC threads is not safe, so workers are spawned.
+            self.executor = futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=import_module,
+                initargs=(self.module,),
+            )
+            # Start every worker now, rather than on the first few requests.
+            warm_up = [self.executor.submit(find_function, self.module, self.name)
+                       for _ in range(self.workers)]
+            futures.wait(warm_up)
+
+    def stop(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __call__(self, request_bytes: bytes) -> Optional[bytes]:
+        executor = self.executor
+        if executor is None:
+            self.start()
+            executor = self.executor
+        try:
+            response, code, details = executor.submit(run_in_worker, self.module, self.name, request_bytes).result()
+        except BrokenProcessPool:
+            self.start(broken=executor)
+            raise exceptions.Unavailable('A worker process died while handling the call')
+        if code is not None:
+            raise exceptions.GRPCError(details=details, code=code)
+        return response
+
+    def wrap(self, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def offloaded(request_bytes):
+            return self(request_bytes)
+        return offloaded
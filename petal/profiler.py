@@ -0,0 +1,145 @@
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import CodeType
+from typing import Dict, Optional
+
+from .log import logger
+
+
+class Profiler:
+    """
+    A sampling profiler that periodically looks at the stack of every thread. A sample is attributed to a method
+    when the method's function is on the stack, and only the frames from that function inwards are kept, so each
+    method gets its own profile. Nothing is added to the path of a call.
+
+    Where threads have their own CPU clocks, a thread is only sampled if it used the CPU since the last sample, so
+    methods blocked on I/O or a lock don't fill their profiles with the frames they wait in.
+
+    Profiles are written in the collapsed stack format used by flamegraph tools, one file per method.
+    """
+
+    def __init__(self, methods: Dict[CodeType, str], output_directory: Path, rate: float = 100):
+        self.methods = methods
+        self.output_directory = output_directory
+        self.interval = 1 / rate
+        self.samples: Dict[str, Counter] = {}
+        self.labels: Dict[CodeType, str] = {}
+        self.clocks: Dict[int, Optional[int]] = {}
+        self.cpu_times: Dict[int, float] = {}
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # Starting and stopping are never run at once, whether asked for by a signal or not.
+        self.lock = threading.Lock()
+        self.toggles: 'queue.SimpleQueue[None]' = queue.SimpleQueue()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='petal-profiler', daemon=True)
+            self.thread.start()
+        logger.info(f'Started profiling at {1 / self.interval:.0f}Hz')
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def listen(self, signum: int = signal.SIGUSR2):
+        """
+        Start or stop profiling whenever the process receives `signum`.
+        """
+        threading.Thread(target=self.follow_toggles, name='petal-profiler-toggle', daemon=True).start()
+        signal.signal(signum, self.toggle)
+
+    def toggle(self, *args):
+        # The signal handler only queues the toggle, SimpleQueue.put being safe to call from one. Starting, stopping,
+        # logging and writing the profiles are all left to the thread following the toggles.
+        self.toggles.put(None)
+
+    def follow_toggles(self):
+        while True:
+            self.toggles.get()
+            if self.running:
+                self.stop()
+            else:
+                self.start()
+
+    def run(self):
+        self.cpu_times = {}
+        while not self.stopped.wait(self.interval):
+            self.sample()
+        self.write()
+
+    def cpu_time(self, thread_id: int) -> Optional[float]:
+        if thread_id not in self.clocks:
+            try:
+                self.clocks[thread_id] = time.pthread_getcpuclockid(thread_id)
+            except (AttributeError, OSError):
+                self.clocks[thread_id] = None
+        clock = self.clocks[thread_id]
+        if clock is None:
+            return None
+        try:
+            return time.clock_gettime(clock)
+        except OSError:
+            return None
+
+    def busy(self, thread_id: int) -> bool:
+        cpu_time = self.cpu_time(thread_id)
+        if cpu_time is None:
+            return True
+        last = self.cpu_times.get(thread_id)
+        self.cpu_times[thread_id] = cpu_time
+        return last is not None and cpu_time > last
+
+    def label(self, code: CodeType) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    def sample(self):
+        own_thread = threading.get_ident()
+        frames = sys._current_frames()
+        for thread_id in set(self.clocks) - set(frames):
+            del self.clocks[thread_id]
+            self.cpu_times.pop(thread_id, None)
+        for thread_id, frame in frames.items():
+            if thread_id == own_thread or not self.busy(thread_id):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(self.label(code))
+                method = self.methods.get(code)
+                if method is not None:
+                    if method not in self.samples:
+                        self.samples[method] = Counter()
+                    self.samples[method][';'.join(reversed(stack))] += 1
+                    break
+                frame = frame.f_back
+
+    def write(self):
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        samples, self.samples = self.samples, {}
+        for method, stacks in samples.items():
+            path = self.output_directory / f'{method}-{os.getpid()}.collapsed'
+            with path.open('a') as fd:
+                for stack, count in stacks.items():
+                    fd.write(f'{stack} {count}\n')
+        logger.info(f'Wrote profiles for {len(samples)} methods to {self.output_directory}')
@@ -1,15 +1,34 @@
+import os
 import sys
 import json
 
 from google.protobuf.compiler import plugin_pb2
 from google.protobuf.json_format import MessageToDict
 
+MANIFEST_NAME = 'petal_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def module_name(proto_file_name: str) -> str:
+    return proto_file_name[:-6].replace('-', '_').replace('/', '.') + '_pb2'
+
 
 def generate_service_metadata(request: plugin_pb2.CodeGeneratorRequest,
                               response: plugin_pb2.CodeGeneratorResponse):
     files = {f.name: f for f in request.proto_file}
     to_generate = {n: files[n] for n in request.file_to_generate}
 
+    # Which module defines each message type, including messages imported from other files.
+    message_modules = {}
+    for fd in request.proto_file:
+        messages = [(f'.{fd.package}' if fd.package else '', message) for message in fd.message_type]
+        while messages:
+            prefix, message = messages.pop()
+            full_name = f'{prefix}.{message.name}'
+            message_modules[full_name] = module_name(fd.name)
+            messages.extend((full_name, nested) for nested in message.nested_type)
+
+    manifest = {}
     for name, fd in to_generate.items():
 
         services = {
@@ -32,6 +51,34 @@ def generate_service_metadata(request: plugin_pb2.CodeGeneratorRequest,
         output.content = 'STREAMING_INFO = %s' % services
         print(f'Writing structure to {output.name}', file=sys.stderr)
 
+        for service in fd.service:
+            manifest[service.name] = {
+                'proto': fd.name,
+                'full_name': f'{fd.package}.{service.name}' if fd.package else service.name,
+                'module': module_name(fd.name),
+                'methods': [
+                    {
+                        'name': method.name,
+                        'input_type': method.input_type.lstrip('.'),
+                        'input_module': message_modules[method.input_type],
+                        'input_stream': method.client_streaming,
+                        'output_type': method.output_type.lstrip('.'),
+                        'output_module': message_modules[method.output_type],
+                        'output_stream': method.server_streaming,
+                    }
+                    for method in service.method
+                ]
+            }
+
+    if manifest:
+        # Written next to the generated modules, so `petal run` can find a service without importing them all.
+        # `petal build` runs protoc several times in parallel, and passes each run its own file name to write to.
+        output = response.file.add()
+        output.name = os.path.join(os.path.dirname(next(iter(to_generate))), request.parameter or MANIFEST_NAME)
+        output.content = json.dumps({'version': MANIFEST_VERSION, 'services': manifest},
+                                    sort_keys=True, separators=(',', ':'))
+        print(f'Writing manifest to {output.name}', file=sys.stderr)
+
 
 def main():
     data = sys.stdin.buffer.read()
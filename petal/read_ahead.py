@@ -0,0 +1,157 @@
+import functools
+import threading
+from collections import deque
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from .exceptions import InternalError
+
+T = TypeVar('T')
+
+# The status and details gRPC gives a call whose request it can't parse.
+UNPARSEABLE = 'Exception deserializing request!'
+
+
+class ReadAhead:
+    """
+    The requests of a client streaming call, read and parsed on a helper thread while the method works on earlier
+    ones. At most `max_messages` parsed requests, or `max_bytes` of them serialized, are held at once: past that the
+    helper stops reading, and the client is held back by gRPC's flow control. A request bigger than `max_bytes` is
+    still read once the buffer is empty.
+    """
+
+    def __init__(self, requests: Iterable[bytes], deserialize: Optional[Callable], max_messages: Optional[int],
+                 max_bytes: Optional[int]):
+        self.deserialize = deserialize
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.buffer: Deque[Tuple[object, int]] = deque()
+        self.bytes = 0
+        self.done = False
+        self.closed = False
+        self.error: Optional[Exception] = None
+        self.thread = threading.Thread(target=self.read, args=(requests,), name='petal-read-ahead', daemon=True)
+        self.thread.start()
+
+    def full(self, size: int) -> bool:
+        if not self.buffer:
+            return False
+        if self.max_messages is not None and len(self.buffer) >= self.max_messages:
+            return True
+        return self.max_bytes is not None and self.bytes + size > self.max_bytes
+
+    def read(self, requests: Iterable[bytes]):
+        error = None
+        try:
+            for data in requests:
+                try:
+                    message = self.deserialize(data) if self.deserialize else data
+                except Exception as e:
+                    raise InternalError(UNPARSEABLE) from e
+                size = len(data)
+                with self.condition:
+                    while self.full(size) and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    self.buffer.append((message, size))
+                    self.bytes += size
+                    self.condition.notify()
+        except Exception as e:
+            error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.error = error
+                self.condition.notify_all()
+
+    def __iter__(self) -> 'ReadAhead':
+        return self
+
+    def __next__(self):
+        with self.condition:
+            while not self.buffer and not self.done:
+                self.condition.wait()
+            if self.buffer:
+                message, size = self.buffer.popleft()
+                self.bytes -= size
+                self.condition.notify()
+                return message
+        if self.error is not None:
+            raise self.error
+        raise StopIteration
+
+    def batches(self, size: int) -> Iterator[List]:
+        """
+        The requests in lists of `size`, the last one holding whatever is left. Every request already read is taken
+        at once, rather than one at a time.
+        """
+        batch = []
+        while True:
+            with self.condition:
+                while not self.buffer and not self.done:
+                    self.condition.wait()
+                while self.buffer and len(batch) < size:
+                    message, length = self.buffer.popleft()
+                    self.bytes -= length
+                    batch.append(message)
+                self.condition.notify()
+                finished = self.done and not self.buffer
+            if len(batch) == size:
+                yield batch
+                batch = []
+            elif finished:
+                if self.error is not None:
+                    raise self.error
+                if batch:
+                    yield batch
+                return
+
+    def close(self):
+        # Called once the method returns, so the helper doesn't hold on to requests nobody will read.
+        with self.condition:
+            self.closed = True
+            self.buffer.clear()
+            self.condition.notify_all()
+
+
+def batches(requests: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Group the requests of a client streaming call into lists of `size`, the last one holding whatever is left, for
+    methods that work on blocks of messages.
+    """
+    if isinstance(requests, ReadAhead):
+        yield from requests.batches(size)
+        return
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_ahead(func: Callable, deserialize: Optional[Callable], stream_output: bool, max_messages: Optional[int],
+               max_bytes: Optional[int]) -> Callable:
+    """
+    Wrap a synchronous client streaming method to be given its requests serialized, and read them ahead with
+    `ReadAhead`.
+    """
+    if stream_output:
+        def reading(requests):
+            requests = ReadAhead(requests, deserialize, max_messages, max_bytes)
+            try:
+                yield from func(requests)
+            finally:
+                requests.close()
+    else:
+        def reading(requests):
+            requests = ReadAhead(requests, deserialize, max_messages, max_bytes)
+            try:
+                return func(requests)
+            finally:
+                requests.close()
+
+    return functools.wraps(func)(reading)
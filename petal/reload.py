@@ -0,0 +1,179 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import List, Set, Dict, Iterable, Optional
+
+import grpc
+
+WATCHED_SUFFIXES = {'.py', '.proto'}
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+SIMPLE_TYPES = (int, float, str, bytes, bool, tuple, type(None))
+
+
+class ReloadingHandler(grpc.GenericRpcHandler):
+    """
+    Passes every call to the current service handler, so a reloaded service can be swapped in without
+    stopping the server or closing its socket.
+    """
+
+    def __init__(self, handler: grpc.GenericRpcHandler):
+        self.handler = handler
+
+    def service(self, handler_call_details):
+        return self.handler.service(handler_call_details)
+
+
+def watched_directories(roots: Iterable[Path]) -> List[Path]:
+    directories = []
+    for root in roots:
+        for directory, subdirectories, _ in os.walk(root):
+            subdirectories[:] = [name for name in subdirectories if name != '__pycache__' and not name.startswith('.')]
+            directories.append(Path(directory))
+    return directories
+
+
+class Watcher:
+    """
+    Waits for source files under the given directories to change, with inotify on Linux and by polling their
+    modification times elsewhere. Changes are collected until nothing has changed for `quiet` seconds, so saving
+    several files at once only causes one reload.
+    """
+
+    def __init__(self, roots: List[Path], quiet: float = 0.1, poll_interval: float = 0.5):
+        self.roots = roots
+        self.quiet = quiet
+        self.poll_interval = poll_interval
+        self.libc = load_inotify()
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+            self.watches: Dict[int, Path] = {}
+            for directory in watched_directories(roots):
+                self.add_watch(directory)
+        else:
+            self.mtimes = self.scan()
+
+    def add_watch(self, directory: Path):
+        wd = self.libc.inotify_add_watch(self.fd, str(directory).encode(), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+
+    def read_events(self, timeout: Optional[float]) -> Set[Path]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0').decode()
+            offset += EVENT_HEADER.size + length
+            if wd not in self.watches:
+                continue
+            path = self.watches[wd] / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name != '__pycache__':
+                    self.add_watch(path)
+            elif path.suffix in WATCHED_SUFFIXES:
+                changed.add(path)
+        return changed
+
+    def scan(self) -> Dict[Path, float]:
+        mtimes = {}
+        for directory in watched_directories(self.roots):
+            for path in directory.iterdir():
+                if path.suffix in WATCHED_SUFFIXES and path.is_file():
+                    mtimes[path] = path.stat().st_mtime
+        return mtimes
+
+    def poll(self) -> Set[Path]:
+        mtimes = self.scan()
+        changed = {path for path in mtimes.keys() | self.mtimes.keys() if mtimes.get(path) != self.mtimes.get(path)}
+        self.mtimes = mtimes
+        return changed
+
+    def wait(self) -> Set[Path]:
+        if self.libc is not None:
+            changed = set()
+            while not changed:
+                changed = self.read_events(None)
+            while True:
+                more = self.read_events(self.quiet)
+                if not more:
+                    return changed
+                changed |= more
+
+        changed = set()
+        while not changed:
+            time.sleep(self.poll_interval)
+            changed = self.poll()
+        return changed
+
+
+def load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def is_generated(path: Path) -> bool:
+    return path.name.endswith(('_pb2.py', '_pb2_grpc.py', '_pb2.pyi'))
+
+
+def affected_modules(changed: Set[Path], package: str, always: Iterable[str] = ()) -> List[str]:
+    """
+    The names of the loaded modules from the changed files, and of every module in `package` that uses something
+    from them. Removing these from sys.modules and importing the service again re-runs them in their usual order.
+    """
+    changed = {path.resolve() for path in changed}
+    affected: Set[str] = set(always)
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path is not None and Path(path).resolve() in changed:
+            affected.add(name)
+
+    candidates = {name: module for name, module in list(sys.modules.items())
+                  if name == package or name.startswith(f'{package}.')}
+    growing = True
+    while growing:
+        growing = False
+        # Objects like the `service` itself don't say which module they came from, so look for them by identity.
+        shared = {id(value) for name in affected if name in sys.modules
+                  for value in module_values(sys.modules[name]) if not isinstance(value, SIMPLE_TYPES)}
+        for name, module in candidates.items():
+            if name not in affected and any(uses(value, affected, shared) for value in module_values(module)):
+                affected.add(name)
+                growing = True
+
+    return [name for name in list(sys.modules) if name in affected]
+
+
+def module_values(module: ModuleType) -> list:
+    # Dunder names like __builtins__ are shared by every module.
+    return [value for name, value in vars(module).items() if not name.startswith('__')]
+
+
+def uses(value, modules: Set[str], shared: Set[int]) -> bool:
+    if isinstance(value, ModuleType):
+        return value.__name__ in modules
+    if isinstance(value, SIMPLE_TYPES):
+        return False
+    return getattr(value, '__module__', None) in modules or id(value) in shared
@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent import futures
+from typing import Dict, Iterable, List, Optional
+
+import grpc
+
+from .bench import MethodResult, percentile
+from .capture import CapturedCall
+
+# Metadata set by gRPC itself rather than the caller, and the trace of the original call, which replays aren't part of.
+RESERVED_METADATA = ('grpc-', ':')
+RESERVED_KEYS = ('user-agent', 'content-type', 'te', 'traceparent')
+
+
+class MethodCalls:
+    """
+    Sends captured calls with their serialized requests as they are, so the service's protobufs aren't needed.
+    """
+
+    def __init__(self, channel: grpc.Channel):
+        self.channel = channel
+        self.callables = {}
+
+    def __call__(self, call: CapturedCall, timeout: Optional[float]):
+        if call.method not in self.callables:
+            shape = f'{"stream" if call.stream_input else "unary"}_{"stream" if call.stream_output else "unary"}'
+            self.callables[call.method] = getattr(self.channel, shape)(call.method)
+
+        metadata = [(key, value) for key, value in call.metadata
+                    if not key.startswith(RESERVED_METADATA) and key not in RESERVED_KEYS]
+        request = iter(call.requests) if call.stream_input else call.requests[0]
+        response = self.callables[call.method](request, timeout=timeout, metadata=metadata)
+        if call.stream_output:
+            for _ in response:
+                pass
+
+
+def replay(calls: Iterable[CapturedCall], target: str, speed: Optional[float], concurrency: int,
+           timeout: float = None) -> List[MethodResult]:
+    """
+    Send the captured calls to `target` again. With a `speed` they are sent at the times they originally arrived,
+    sped up by that factor, and latency is measured from when each call should have been sent, so a server that
+    falls behind is seen to. Without, they are sent as fast as `concurrency` concurrent calls allow.
+    """
+    results: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    with grpc.insecure_channel(target) as channel:
+        send = MethodCalls(channel)
+
+        def run(call: CapturedCall, scheduled: Optional[float]):
+            start = time.perf_counter() if scheduled is None else scheduled
+            failed = False
+            try:
+                send(call, timeout)
+            except grpc.RpcError:
+                failed = True
+            latency = time.perf_counter() - start
+            with lock:
+                results.setdefault(call.method, []).append(latency)
+                if failed:
+                    errors[call.method] = errors.get(call.method, 0) + 1
+
+        started = time.perf_counter()
+        first = None
+        # Don't read far ahead of the calls being sent, captures can be large.
+        slots = threading.BoundedSemaphore(concurrency * 4)
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for call in calls:
+                scheduled = None
+                if speed is not None:
+                    first = call.start if first is None else first
+                    scheduled = started + (call.start - first) / speed
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()
+                executor.submit(run, call, scheduled).add_done_callback(lambda _: slots.release())
+        elapsed = time.perf_counter() - started
+
+    method_results = []
+    for method, latencies in sorted(results.items()):
+        latencies.sort()
+        method_results.append(MethodResult(
+            name=method,
+            requests=len(latencies),
+            errors=errors.get(method, 0),
+            rps=len(latencies) / elapsed,
+            p50_ms=percentile(latencies, 0.5) * 1000,
+            p99_ms=percentile(latencies, 0.99) * 1000,
+            p999_ms=percentile(latencies, 0.999) * 1000,
+        ))
+    return method_results
@@ -0,0 +1,279 @@
+import time
+from typing import Callable, Iterable, NamedTuple, Optional, Tuple, Dict, Any
+
+import grpc
+from google.protobuf.message import Message
+
+MODES = ('direct', 'wire')
+
+
+class Metadatum(NamedTuple):
+    key: str
+    value: Any
+
+
+class CallError(grpc.RpcError):
+    """
+    Raised by the test client when a call fails, with the same `code()` and `details()` methods as the errors raised
+    by a real gRPC stub.
+    """
+
+    def __init__(self, code: grpc.StatusCode, details: Optional[str], trailing_metadata: Tuple = ()):
+        super().__init__(f'{code.name}: {details}' if details else code.name)
+        self._code = code
+        self._details = details
+        self._trailing_metadata = trailing_metadata
+
+    def code(self) -> grpc.StatusCode:
+        return self._code
+
+    def details(self) -> Optional[str]:
+        return self._details
+
+    def trailing_metadata(self) -> Tuple:
+        return self._trailing_metadata
+
+
+class TestContext:
+    """
+    Stands in for the `grpc.ServicerContext` of a call made by the test client.
+    """
+    __test__ = False
+
+    def __init__(self, metadata: Iterable[Tuple[str, Any]] = (), timeout: float = None, peer: str = 'test'):
+        self.metadata = tuple(Metadatum(key, value) for key, value in metadata)
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self._peer = peer
+        self._code: Optional[grpc.StatusCode] = None
+        self._details: Optional[str] = None
+        self._trailing_metadata: Tuple = ()
+        self.initial_metadata: Tuple = ()
+        self.cancelled_call = False
+        self.callbacks = []
+
+    def invocation_metadata(self):
+        return self.metadata
+
+    def peer(self) -> str:
+        return self._peer
+
+    def peer_identities(self):
+        return None
+
+    def auth_context(self):
+        return {}
+
+    def time_remaining(self) -> Optional[float]:
+        return None if self.deadline is None else max(self.deadline - time.monotonic(), 0)
+
+    def is_active(self) -> bool:
+        return not self.cancelled_call and self.time_remaining() != 0
+
+    def cancel(self):
+        self.cancelled_call = True
+        for callback in self.callbacks:
+            callback()
+        return True
+
+    def add_callback(self, callback: Callable) -> bool:
+        self.callbacks.append(callback)
+        return True
+
+    def send_initial_metadata(self, initial_metadata):
+        self.initial_metadata = tuple(initial_metadata)
+
+    def set_trailing_metadata(self, trailing_metadata):
+        self._trailing_metadata = tuple(trailing_metadata)
+
+    def trailing_metadata(self):
+        return self._trailing_metadata
+
+    def set_code(self, code: grpc.StatusCode):
+        self._code = code
+
+    def set_details(self, details: str):
+        self._details = details
+
+    def code(self) -> Optional[grpc.StatusCode]:
+        return self._code
+
+    def details(self) -> Optional[str]:
+        return self._details
+
+    def abort(self, code: grpc.StatusCode, details: str = ''):
+        self._code, self._details = code, details
+        raise CallError(code, details, self._trailing_metadata)
+
+    def abort_with_status(self, status):
+        self.set_trailing_metadata(status.trailing_metadata)
+        self.abort(status.code, status.details)
+
+    def set_compression(self, compression):
+        pass
+
+    def disable_next_message_compression(self):
+        pass
+
+    def error(self) -> Optional[CallError]:
+        if self._code is None or self._code == grpc.StatusCode.OK:
+            return None
+        return CallError(self._code, self._details, self._trailing_metadata)
+
+
+class AsyncTestContext(TestContext):
+    """
+    Stands in for the `grpc.aio.ServicerContext` of a call to an async method.
+    """
+    __test__ = False
+
+    async def abort(self, code: grpc.StatusCode, details: str = '', trailing_metadata=()):
+        self._code, self._details = code, details
+        if trailing_metadata:
+            self.set_trailing_metadata(trailing_metadata)
+        raise grpc.aio.AbortError()
+
+    def cancelled(self) -> bool:
+        return self.cancelled_call
+
+    def done(self) -> bool:
+        return self.cancelled_call
+
+    def add_done_callback(self, callback: Callable):
+        self.callbacks.append(callback)
+
+
+def identity(value):
+    return value
+
+
+async def aiter_requests(requests):
+    if hasattr(requests, '__aiter__'):
+        async for request in requests:
+            yield request
+    else:
+        for request in requests:
+            yield request
+
+
+class MethodCaller:
+    """
+    Calls one method the way the gRPC server would, through the handler petal gives it. In "wire" mode every
+    message is serialized and parsed again on the way in and out, like it would be on the network. In "direct" mode
+    messages are passed straight through, unless the method works with the serialized bytes itself.
+    """
+
+    def __init__(self, method, metrics, mode: str, metadata: Iterable[Tuple[str, Any]], timeout: Optional[float]):
+        method_handler = method.create_method_handler(metrics)
+        self.name = method.name
+        self.is_async = method.is_async
+        self.stream_input = method_handler.request_streaming
+        self.stream_output = method_handler.response_streaming
+        self.behaviour = (method_handler.unary_unary or method_handler.unary_stream or
+                          method_handler.stream_unary or method_handler.stream_stream)
+        self.metadata = metadata
+        self.timeout = timeout
+
+        deserializer = method_handler.request_deserializer or identity
+        serializer = method_handler.response_serializer or identity
+        output_type = method.output_type
+        if mode == 'direct' and method_handler.request_deserializer == method.input_type.FromString:
+            self.prepare_request = identity
+        else:
+            self.prepare_request = lambda request: deserializer(request.SerializeToString())
+        if mode == 'direct' and method_handler.response_serializer == output_type.SerializeToString:
+            self.read_response = identity
+        else:
+            self.read_response = lambda response: output_type.FromString(serializer(response))
+
+    def context(self, metadata, timeout) -> TestContext:
+        context_type = AsyncTestContext if self.is_async else TestContext
+        return context_type(self.metadata if metadata is None else metadata,
+                            self.timeout if timeout is None else timeout)
+
+    def __call__(self, request, metadata: Iterable[Tuple[str, Any]] = None, timeout: float = None):
+        context_object = self.context(metadata, timeout)
+        if not self.stream_input:
+            request = self.prepare_request(request)
+        elif self.is_async:
+            request = self.async_requests(request)
+        else:
+            request = map(self.prepare_request, request)
+
+        if self.is_async and self.stream_output:
+            return self.call_async_stream(request, context_object)
+        if self.is_async:
+            return self.call_async(request, context_object)
+        if self.stream_output:
+            return self.call_stream(request, context_object)
+
+        response = self.behaviour(request, context_object)
+        return self.finish(response, context_object)
+
+    def finish(self, response, context_object: TestContext) -> Message:
+        error = context_object.error()
+        if error is not None:
+            raise error
+        if response is None:
+            raise CallError(grpc.StatusCode.UNKNOWN, f'Exception calling application: {self.name}')
+        return self.read_response(response)
+
+    def call_stream(self, request, context_object: TestContext):
+        for response in self.behaviour(request, context_object):
+            yield self.read_response(response)
+        error = context_object.error()
+        if error is not None:
+            raise error
+
+    async def async_requests(self, requests):
+        async for request in aiter_requests(requests):
+            yield self.prepare_request(request)
+
+    async def call_async(self, request, context_object: TestContext) -> Message:
+        try:
+            response = await self.behaviour(request, context_object)
+        except grpc.aio.AbortError:
+            raise context_object.error()
+        return self.finish(response, context_object)
+
+    async def call_async_stream(self, request, context_object: TestContext):
+        try:
+            async for response in self.behaviour(request, context_object):
+                yield self.read_response(response)
+        except grpc.aio.AbortError:
+            raise context_object.error()
+        error = context_object.error()
+        if error is not None:
+            raise error
+
+
+class TestClient:
+    """
+    Calls a service's methods in-process, without a server or network. Methods can be called by their gRPC name or
+    their Python name:
+
+        client = service.test_client()
+        reply = client.SayHello(HelloRequest(name='petal'))
+
+    Unary responses are returned, streamed responses are returned as an iterator, and streaming methods take an
+    iterable of requests. Async methods return a coroutine or an async iterator instead. Failed calls raise a
+    `CallError` with the status code and details the method set.
+    """
+    __test__ = False
+
+    def __init__(self, service, mode: str = 'direct', metadata: Iterable[Tuple[str, Any]] = (),
+                 timeout: float = None):
+        if mode not in MODES:
+            raise ValueError(f'Unknown test client mode {mode}, expected one of {", ".join(MODES)}')
+        service.start_process_pools()
+        self.methods: Dict[str, MethodCaller] = {}
+        for method in service.rpc_methods:
+            metrics = service.metrics and service.metrics.method(service.qualified_name(method.name))
+            caller = MethodCaller(method, metrics, mode, tuple(metadata), timeout)
+            self.methods[method.name] = caller
+            self.methods[method.python_name] = caller
+
+    def __getattr__(self, item) -> MethodCaller:
+        try:
+            return self.methods[item]
+        except KeyError:
+            raise AttributeError(item) from None
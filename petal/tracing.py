@@ -0,0 +1,334 @@
+import contextvars
+import inspect
+import json
+import os
+import random
+import time
+from typing import Optional, Callable, List, Dict, Any, NamedTuple, Iterable, Iterator
+
+from .background import BackgroundBuffer, wall_clock_offset
+from .dispatch import wrap_calls
+from .log import logger
+from .metrics import status_code
+
+span = contextvars.ContextVar('petal.span')
+
+TRACEPARENT = 'traceparent'
+SAMPLED = 0x01
+
+
+def current_span() -> Optional['Span']:
+    """
+    The span of the current call, or None if it is not being traced.
+    """
+    return span.get(None)
+
+
+class TraceParent(NamedTuple):
+    trace_id: int
+    span_id: int
+    sampled: bool
+
+
+def parse_traceparent(value: str) -> Optional[TraceParent]:
+    # W3C trace context: version-trace_id-parent_id-flags, like 00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01
+    parts = value.split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        trace_id, span_id, flags = int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    if not trace_id or not span_id:
+        return None
+    return TraceParent(trace_id, span_id, bool(flags & SAMPLED))
+
+
+class Span:
+    """
+    A timed operation within a trace. Times are taken with perf_counter while the span is open, and turned into
+    seconds since the epoch when it is exported.
+    """
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'start', 'end', 'status', 'attributes')
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: int, parent_id: Optional[int] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64) or 1
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.status: Optional[str] = None
+        self.attributes: Optional[Dict[str, Any]] = None
+
+    def set_attribute(self, key: str, value):
+        if self.attributes is None:
+            self.attributes = {}
+        self.attributes[key] = value
+
+    def child(self, name: str) -> 'Span':
+        """
+        Start a span for part of this one's work. Use it in a `with` block, or call `finish()` when it is done.
+        """
+        return Span(self.tracer, name, self.trace_id, self.span_id)
+
+    def finish(self, status: str = None):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        self.status = status
+        self.tracer.buffer.add(self)
+
+    def traceparent(self) -> str:
+        """
+        The `traceparent` metadata to send with calls made on behalf of this span, to continue its trace.
+        """
+        return f'00-{self.trace_id:032x}-{self.span_id:016x}-01'
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(None if exc_type is None else exc_type.__name__)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': f'{self.trace_id:032x}',
+            'span_id': f'{self.span_id:016x}',
+            'parent_id': None if self.parent_id is None else f'{self.parent_id:016x}',
+            'name': self.name,
+            'start': round(self.start, 6),
+            'end': round(self.end, 6),
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'status': self.status,
+            'attributes': self.attributes or {},
+        }
+
+
+class SpanExporter:
+    """
+    Receives finished spans in batches on the tracer's background thread. Subclass it to send spans anywhere.
+    """
+
+    def export(self, spans: List[Span]):
+        raise NotImplementedError()
+
+    def shutdown(self):
+        pass
+
+
+class InMemoryExporter(SpanExporter):
+    """
+    Keeps every exported span in `spans`, for tests.
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+
+class FileExporter(SpanExporter):
+    """
+    Appends each span to a file as a JSON line.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    def export(self, spans: List[Span]):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        data = ''.join(json.dumps(finished.to_dict(), default=str, separators=(',', ':')) + '\n'
+                       for finished in spans).encode()
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def shutdown(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class TracerStats(NamedTuple):
+    exported: int
+    dropped: int
+    buffered: int
+
+
+class Tracer:
+    """
+    Opens a span for each call, continuing the trace from the caller's `traceparent` metadata when there is one,
+    and a child span for each message of a streaming call. Finished spans are handed to the exporter in batches by
+    a background thread.
+
+    Calls continue their caller's decision to sample the trace or not. Calls starting a new trace are sampled at
+    `rate`, decided before anything is created for them, so calls that are not traced cost close to nothing.
+    """
+
+    def __init__(self, exporter: SpanExporter, rate: float = 0.01, capacity: int = 65536, batch_size: int = 512,
+                 flush_interval: float = 1.0):
+        self.exporter = exporter
+        self.rate = rate
+        self.buffer = BackgroundBuffer(self.export, capacity, batch_size, flush_interval, 'petal-tracing')
+        self.exported = 0
+        self.failed = 0
+        self.failing = False
+
+    def start_call(self, name: str, context_object) -> Optional[Span]:
+        parent = None
+        for key, value in context_object.invocation_metadata():
+            if key == TRACEPARENT:
+                parent = parse_traceparent(value)
+                break
+        if parent is None:
+            if self.rate <= 0 or random.random() >= self.rate:
+                return None
+            return Span(self, name, random.getrandbits(128) or 1)
+        if not parent.sampled:
+            return None
+        return Span(self, name, parent.trace_id, parent.span_id)
+
+    def wrap(self, dispatcher: Callable, name: str, stream_input: bool, stream_output: bool) -> Callable:
+        """
+        Wrap the outermost dispatcher of a method to trace the calls it handles.
+        """
+        start_call = self.start_call
+        is_async = inspect.iscoroutinefunction(dispatcher) or inspect.isasyncgenfunction(dispatcher)
+
+        def enter(request, context_object) -> Optional[tuple]:
+            call_span = start_call(name, context_object)
+            if call_span is None:
+                return None
+            if is_async:
+                # Every call on a grpc.aio server runs in its own task, with its own copy of the context.
+                span.set(call_span)
+                return call_span, None, context_object
+            # Streams only set it while they are first pulled from, in send_spans().
+            return call_span, None if stream_output else span.set(call_span), context_object
+
+        def leave(state: Optional[tuple], result):
+            if state is None:
+                return
+            call_span, token, context_object = state
+            if token is not None:
+                span.reset(token)
+            call_span.finish(status_code(context_object, result).name)
+
+        def requests(state: Optional[tuple], stream):
+            if state is None:
+                return stream
+            return (async_receive_spans if is_async else receive_spans)(state[0], stream)
+
+        def responses(state: Optional[tuple], stream):
+            if state is None:
+                return stream
+            return (async_send_spans if is_async else send_spans)(state[0], stream)
+
+        return wrap_calls(dispatcher, stream_output, enter, leave, requests=requests if stream_input else None,
+                          responses=responses if stream_output else None)
+
+    def export(self, spans: List[Span]):
+        offset = wall_clock_offset()
+        for finished in spans:
+            finished.start += offset
+            finished.end += offset
+        try:
+            self.exporter.export(spans)
+        except Exception:
+            self.failed += len(spans)
+            if not self.failing:
+                logger.exception(f'Could not export spans with {type(self.exporter).__name__}, dropping them')
+            self.failing = True
+            return
+        self.failing = False
+        self.exported += len(spans)
+
+    def stats(self) -> TracerStats:
+        return TracerStats(exported=self.exported, dropped=self.buffer.dropped + self.failed,
+                           buffered=len(self.buffer))
+
+    def start(self):
+        """
+        Start the export thread. Forked worker processes each start their own.
+        """
+        self.buffer.start()
+
+    def stop(self):
+        """
+        Export the remaining spans and stop the export thread.
+        """
+        if self.buffer.running:
+            self.buffer.stop()
+            self.exporter.shutdown()
+
+
+STOP = object()
+
+
+def send_spans(call_span: Span, responses: Iterator) -> Iterator:
+    # The stream dispatcher copies the context to run the method in when it first runs.
+    token = span.set(call_span)
+    try:
+        first = send_span(call_span, responses)
+    finally:
+        span.reset(token)
+    if first is STOP:
+        return
+    yield first
+    while True:
+        response = send_span(call_span, responses)
+        if response is STOP:
+            return
+        yield response
+
+
+def send_span(call_span: Span, responses) -> Any:
+    # Each streamed response gets a span for the time taken to produce it.
+    message_span = call_span.child('send')
+    try:
+        response = next(responses)
+    except StopIteration:
+        return STOP
+    message_span.finish()
+    return response
+
+
+def receive_spans(call_span: Span, requests: Iterable) -> Iterable:
+    # Each streamed request gets a span for the time spent waiting for it.
+    requests = iter(requests)
+    while True:
+        message_span = call_span.child('receive')
+        try:
+            request = next(requests)
+        except StopIteration:
+            return
+        message_span.finish()
+        yield request
+
+
+async def async_send_spans(call_span: Span, responses):
+    responses = responses.__aiter__()
+    while True:
+        message_span = call_span.child('send')
+        try:
+            response = await responses.__anext__()
+        except StopAsyncIteration:
+            return
+        message_span.finish()
+        yield response
+
+
+async def async_receive_spans(call_span: Span, requests):
+    requests = requests.__aiter__()
+    while True:
+        message_span = call_span.child('receive')
+        try:
+            request = await requests.__anext__()
+        except StopAsyncIteration:
+            return
+        message_span.finish()
+        yield request
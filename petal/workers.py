@@ -0,0 +1,113 @@
+import os
+import signal
+import time
+from typing import Callable, Dict
+
+from .log import logger
+
+
+def worker_count(value: str) -> int:
+    if value == 'auto':
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+    return int(value)
+
+
+class Supervisor:
+    """
+    Forks a number of worker processes that each run `target` with their index, restarting any that crash, are
+    killed by a signal or exit with a non-zero status. A worker that keeps exiting within `stable_after` seconds of
+    starting is restarted after twice the previous delay each time, up to `max_restart_delay`.
+    SIGINT and SIGTERM are forwarded to every worker as SIGINT, which they handle as a graceful shutdown.
+    """
+
+    def __init__(self, target: Callable[[int], None], workers: int, restart_delay: float = 1,
+                 max_restart_delay: float = 60, stable_after: float = 30):
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.children: Dict[int, int] = {}
+        self.started: Dict[int, float] = {}
+        self.delays: Dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            # Move into our own process group so a Ctrl+C in the terminal only reaches the supervisor.
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            exit_code = 0
+            try:
+                self.target(index)
+            except BaseException:
+                logger.exception(f'Worker {index} crashed')
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self.children[pid] = index
+        self.started[index] = time.monotonic()
+        logger.info(f'Started worker {index} with pid {pid}')
+
+    def stop(self, signum, frame):
+        if not self.stopping:
+            logger.info(f'Stopping {len(self.children)} workers.')
+        self.stopping = True
+        for pid in self.children:
+            os.kill(pid, signal.SIGINT)
+
+    def forward(self, signum, frame):
+        for pid in self.children:
+            os.kill(pid, signum)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGUSR2, self.forward)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if not os.WIFSIGNALED(status) and os.WEXITSTATUS(status) == 0:
+                logger.info(f'Worker {index} (pid {pid}) exited, not restarting it.')
+                continue
+
+            if time.monotonic() - self.started[index] < self.stable_after:
+                delay = min(self.delays.get(index, self.restart_delay / 2) * 2, self.max_restart_delay)
+            else:
+                delay = self.restart_delay
+            self.delays[index] = delay
+            logger.warning(f'Worker {index} (pid {pid}) {exit_description(status)}, '
+                           f'restarting it in {delay:g} seconds.')
+            self.sleep(delay)
+            if not self.stopping:
+                self.spawn(index)
+
+        logger.info('All workers stopped.')
+
+    def sleep(self, seconds: float):
+        # Stop waiting as soon as we are asked to stop.
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+
+
+def exit_description(status: int) -> str:
+    # os.waitstatus_to_exitcode needs Python 3.9.
+    if os.WIFSIGNALED(status):
+        return f'was killed by signal {os.WTERMSIG(status)}'
+    return f'exited with status {os.WEXITSTATUS(status)}'